@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import logging
+import threading
+import socketserver
+
+from nodes import (
+    RequirementExtractionNode,
+    PlanGeneratorNode,
+    ContextualTestGeneratorNode,
+    FinalReviewerNode,
+    FileWriterNode,
+    DiffUpdateNode,
+    _test_file_path
+)
+from utils.call_llm import token_usage, latency_report
+from utils.project_index import ContentStore, scan_project
+from utils.source_diff import load_baseline
+from utils.vector_store import VectorStore, vector_store_dir
+from tui import print_step
+from rpc_client import DEFAULT_SOCKET
+
+logger = logging.getLogger("llm_logger")
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+class InvalidParams(ValueError):
+    """Raised by RPC methods for bad request params, as opposed to failures inside the pipeline."""
+
+
+class CirkitlyDaemon:
+    """
+    Keeps the project model, content store, spec vector store and LLM client
+    resident between requests, and refreshes the project model as files change.
+    """
+
+    def __init__(self, repo_path: str, spec_dir: str = "specs", interval: float = 2.0):
+        if not os.path.isdir(repo_path):
+            raise NotADirectoryError(f"Path is not a valid directory: {repo_path}")
+        self.repo_path = repo_path
+        self.spec_dir = spec_dir
+        self.interval = interval
+        self.content_store = ContentStore()
+        self.embedding_cache = {}
+        self.vector_store = VectorStore(vector_store_dir(repo_path))
+        self.project_structure = scan_project(repo_path, spec_dir)
+        self.started_at = time.time()
+        self.last_refresh = self.started_at
+        self.request_count = 0
+        self._state_lock = threading.Lock()
+        # The nodes draw rich status spinners, and rich allows only one live display at a time.
+        self._work_lock = threading.Lock()
+
+    def _records(self, project_structure):
+        return {r.path: r for group in project_structure.values() for r in group.values()}
+
+    def refresh(self) -> list:
+        """Rescans the tree, re-reading only files whose size or mtime changed. Returns the changed paths."""
+        with self._state_lock:
+            previous = self._records(self.project_structure)
+        updated = scan_project(self.repo_path, self.spec_dir, previous)
+        current = self._records(updated)
+
+        changed = [p for p, r in current.items() if p not in previous or previous[p].digest != r.digest]
+        changed += [p for p in previous if p not in current]
+        for path in changed:
+            self.content_store.invalidate(path)
+
+        with self._state_lock:
+            self.project_structure = updated
+            self.last_refresh = time.time()
+        if changed:
+            logger.info(f"Daemon refreshed {len(changed)} changed files")
+        return changed
+
+    def watch(self, stop_event: threading.Event):
+        """Polls the tree for changes until `stop_event` is set."""
+        while not stop_event.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Daemon refresh failed: {e}")
+
+    def _shared(self, filename: str) -> dict:
+        with self._state_lock:
+            project_structure = self.project_structure
+        record = project_structure["sources"].get(filename)
+        if record is None:
+            raise InvalidParams(f"Unknown source file: {filename}")
+        return {
+            "project_structure": project_structure,
+            "repo_path": self.repo_path,
+            "content_store": self.content_store,
+            "embedding_cache": self.embedding_cache,
+            "vector_store": self.vector_store,
+            "target_file": {
+                "path": record.path,
+                "content": self.content_store.get(record.path),
+                "dependencies": record.dependencies,
+            },
+        }
+
+    # --- RPC methods ---
+    def status(self, params: dict) -> dict:
+        with self._state_lock:
+            counts = {group: len(records) for group, records in self.project_structure.items()}
+            sources = sorted(self.project_structure["sources"])
+        return {
+            "repo_path": self.repo_path,
+            "files": counts,
+            "sources": sources,
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "last_refresh": self.last_refresh,
+            "requests": self.request_count,
+            "content_cache": {
+                "bytes": self.content_store.current_bytes,
+                "hits": self.content_store.hits,
+                "misses": self.content_store.misses,
+            },
+            "spec_vectors": len(self.vector_store),
+            "token_usage": dict(token_usage),
+            "llm_latency": latency_report(),
+        }
+
+    def _file_param(self, params: dict) -> str:
+        if not isinstance(params.get("file"), str):
+            raise InvalidParams("Missing required string param 'file'.")
+        return params["file"]
+
+    def plan(self, params: dict) -> dict:
+        shared = self._shared(self._file_param(params))
+        with self._work_lock:
+            RequirementExtractionNode().run(shared)
+            PlanGeneratorNode().run(shared)
+        return {"file": params["file"], "plan": shared["test_plan"]}
+
+    def generate(self, params: dict) -> dict:
+        """
+        Generates tests non-interactively. An approved `plan` may be passed in to
+        skip planning. An existing test file is never silently replaced: if its
+        source changed since generation the tests are updated from the diff,
+        otherwise the request is refused unless `overwrite` is true.
+        """
+        shared = self._shared(self._file_param(params))
+        test_path = _test_file_path(shared["target_file"]["path"])
+        write = params.get("write", True)
+        if write and os.path.exists(test_path) and not params.get("overwrite", False):
+            baseline = load_baseline(self.repo_path, shared["target_file"]["path"])
+            if baseline is None or baseline == shared["target_file"]["content"]:
+                raise InvalidParams(f"Test file {test_path} already exists; pass \"overwrite\": true to replace it.")
+            shared["baseline_source"] = baseline
+            with self._work_lock:
+                DiffUpdateNode().run(shared)
+            return {"file": params["file"], "test_file": test_path, "updated": shared.get("maintenance_summary")}
+
+        with self._work_lock:
+            if params.get("plan"):
+                shared["test_plan"] = params["plan"]
+            else:
+                RequirementExtractionNode().run(shared)
+                PlanGeneratorNode().run(shared)
+            ContextualTestGeneratorNode().run(shared)
+            FinalReviewerNode().run(shared)
+
+            result = {"file": params["file"], "plan": shared["test_plan"], "tests": shared["generated_tests"]}
+            if write:
+                writer = FileWriterNode()
+                inputs = {"filename": test_path, "content": shared["generated_tests"]}
+                writer.post(shared, inputs, writer.exec(inputs))
+                result["test_file"] = shared["test_file_path"]
+        return result
+
+    def dispatch(self, raw: str) -> dict:
+        """Handles one JSON-RPC 2.0 request and returns the response object."""
+        try:
+            request = json.loads(raw)
+        except json.JSONDecodeError as e:
+            return _error(None, PARSE_ERROR, f"Parse error: {e}")
+
+        if not isinstance(request, dict):
+            return _error(None, INVALID_REQUEST, "Invalid Request: expected a JSON object (batches are not supported)")
+
+        req_id = request.get("id")
+        handler = {"status": self.status, "plan": self.plan, "generate": self.generate}.get(request.get("method"))
+        if handler is None:
+            return _error(req_id, METHOD_NOT_FOUND, f"Method not found: {request.get('method')}")
+
+        params = request.get("params") or {}
+        if not isinstance(params, dict):
+            return _error(req_id, INVALID_PARAMS, "Invalid params: expected a JSON object")
+        self.request_count += 1
+        try:
+            return {"jsonrpc": "2.0", "id": req_id, "result": handler(params)}
+        except InvalidParams as e:
+            return _error(req_id, INVALID_PARAMS, f"Invalid params: {e}")
+        except Exception as e:
+            logger.error(f"Daemon request failed: {e}")
+            return _error(req_id, SERVER_ERROR, str(e))
+
+
+def _error(req_id, code: int, message: str) -> dict:
+    return {"jsonrpc": "2.0", "id": req_id, "error": {"code": code, "message": message}}
+
+
+class _RpcHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # Newline-delimited JSON: one request per line, one response per line.
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.cirkitly.dispatch(line.decode("utf-8"))
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class _RpcServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(repo_path: str, socket_path: str = DEFAULT_SOCKET, spec_dir: str = "specs", interval: float = 2.0):
+    """Runs the daemon until interrupted, serving JSON-RPC on a Unix socket."""
+    cirkitly = CirkitlyDaemon(repo_path, spec_dir, interval)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=cirkitly.watch, args=(stop_event,), daemon=True)
+    watcher.start()
+
+    with _RpcServer(socket_path, _RpcHandler) as server:
+        server.cirkitly = cirkitly
+        os.chmod(socket_path, 0o600)
+        print_step(f"Cirkitly daemon serving [path]{repo_path}[/path] on [path]{socket_path}[/path]")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop_event.set()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
@@ -2,18 +2,23 @@ from pocketflow import Flow
 from nodes import (
     ProjectParserNode, 
     CandidateSelectionNode,      # Renamed
+    ChangeDetectionNode,
+    DiffUpdateNode,
     RequirementExtractionNode,
     PlanGeneratorNode,           # Renamed
     HumanApprovalNode,
     ContextualTestGeneratorNode, 
     FinalReviewerNode,
     FileWriterNode,
-    MakefileGeneratorNode
+    MakefileGeneratorNode,
+    CoverageTopUpNode
 )
 
 def create_repo_testgen_flow():
     parser_node = ProjectParserNode()
     selector_node = CandidateSelectionNode()         # Renamed
+    change_node = ChangeDetectionNode()
+    update_node = DiffUpdateNode()
     extractor_node = RequirementExtractionNode()
     plan_generator_node = PlanGeneratorNode()        # Renamed
     human_approval_node = HumanApprovalNode()
@@ -21,11 +26,15 @@ def create_repo_testgen_flow():
     reviewer_node = FinalReviewerNode()
     writer_node = FileWriterNode()
     makefile_node = MakefileGeneratorNode()
+    coverage_node = CoverageTopUpNode()
 
     # The new, collaborative "plan-first" flow
-    (parser_node >> selector_node >> extractor_node >> plan_generator_node >> 
+    (parser_node >> selector_node >> change_node >> extractor_node >> plan_generator_node >> 
      human_approval_node >> generator_node >> reviewer_node >> 
-     writer_node >> makefile_node)
+     writer_node >> makefile_node >> coverage_node)
+
+    # Diff-based maintenance when the source changed since its tests were generated
+    change_node - "update" >> update_node >> makefile_node
     
     return Flow(start=parser_node)
 
@@ -1,12 +1,48 @@
 # File: cirkitly/main.py
 
-from flow import repo_testgen_flow
+import argparse
+import json
 import sys
 
+
+def daemon_command(argv):
+    """
+    Handles `main.py serve` (run the resident daemon) and
+    `main.py rpc <method> [json-params]` (send one request to it).
+    """
+    # The rpc client avoids importing the pipeline, so editor and pre-commit calls start fast.
+    from rpc_client import DEFAULT_SOCKET, rpc_call
+
+    parser = argparse.ArgumentParser(prog="main.py")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="Run a daemon with warm caches on a Unix socket.")
+    serve_parser.add_argument("--repo", default="my_c_project", help="Path to the C project.")
+    serve_parser.add_argument("--specs", default="specs", help="Directory of specification documents.")
+    serve_parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path.")
+    serve_parser.add_argument("--interval", type=float, default=2.0, help="Seconds between change scans.")
+    rpc_parser = subparsers.add_parser("rpc", help="Send a request to a running daemon.")
+    rpc_parser.add_argument("method", choices=["status", "plan", "generate"])
+    rpc_parser.add_argument("params", nargs="?", default="{}", help='JSON params, e.g. \'{"file": "spi.c"}\'')
+    rpc_parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path.")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        from daemon import serve
+        serve(args.repo, args.socket, args.specs, args.interval)
+    else:
+        print(json.dumps(rpc_call(args.method, json.loads(args.params), args.socket), indent=2))
+
 def main():
     """
     Main function to run the repository test generation bot.
     """
+    if len(sys.argv) > 1 and sys.argv[1] in ("serve", "rpc"):
+        daemon_command(sys.argv[1:])
+        return
+
+    from flow import repo_testgen_flow
+    from utils.call_llm import latency_report, token_usage
+
     print("Welcome to Cirkitly: The AI Test Generation Copilot")
     
     shared = {}
@@ -20,6 +56,17 @@ def main():
         makefile_status = shared.get('makefile_status', 'Makefile generator did not run.')
         print(f"  - {output_status}")
         print(f"  - {makefile_status}")
+        if 'coverage_status' in shared:
+            print(f"  - {shared['coverage_status']}")
+        if token_usage["prompt_tokens"]:
+            cached_pct = 100.0 * token_usage["cached_tokens"] / token_usage["prompt_tokens"]
+            print(f"  - LLM tokens: {token_usage['prompt_tokens']} prompt ({token_usage['cached_tokens']} cached, "
+                  f"{cached_pct:.0f}%), {token_usage['completion_tokens']} completion")
+        for name, stats in latency_report().items():
+            if stats["requests"]:
+                total = stats["total"]
+                print(f"  - LLM {name}: {stats['requests']} requests, {stats['wins']} hedge wins, "
+                      f"p50/p95/p99 {total['p50']:.1f}/{total['p95']:.1f}/{total['p99']:.1f}s")
         
         if 'repo_path' in shared:
             print("\nTo run your new tests, navigate to the project directory and run:")
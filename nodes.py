@@ -1,13 +1,46 @@
 import os
-import glob
 from pocketflow import Node
-from utils.call_llm import call_llm
+from utils.call_llm import call_llm, token_usage
+from utils.c_code import extract_c_code, is_c_code_complete
+from utils.coverage import build_tests, measure_coverage, uncovered_functions, extract_test_functions, merge_test_functions
 from utils.get_embedding import get_embedding
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
+from utils.source_diff import diff_sources, function_sources, relevant_tests, with_callers, apply_test_patch, load_baseline, save_baseline
+from utils.project_index import ContentStore, load_index, save_index, scan_project
+from utils.vector_store import VectorStore, vector_store_dir
+from prompts import (
+    PLAN_SYSTEM, PLAN_USER, GENERATE_SYSTEM, GENERATE_USER, REVIEW_SYSTEM, REVIEW_USER,
+    TOP_UP_SYSTEM, TOP_UP_USER, UPDATE_SYSTEM, UPDATE_USER, build_messages, project_context
+)
 from tui import console, print_step, prompt_for_input, prompt_for_choice, status, prompt_for_confirmation, print_plan
 
-# ... (ProjectParserNode is unchanged) ...
+
+def _test_file_path(source_path):
+    """Returns the path of the Unity test file generated for a source file."""
+    base, _ = os.path.splitext(os.path.basename(source_path))
+    return os.path.join(os.path.dirname(source_path), f"test_{base}.c")
+
+
+def _include_dirs(shared):
+    """Directories holding the target module's headers, plus the repo's include/."""
+    headers = shared["project_structure"]["headers"]
+    include_dirs = {os.path.dirname(headers[h].path) for h in shared["target_file"]["dependencies"] if h in headers}
+    include_dirs.add(os.path.join(shared["repo_path"], "include"))
+    return sorted(include_dirs)
+
+
+def _project_context(shared):
+    """Shared prompt prefix for every module in the project, computed once per run."""
+    if "project_context" not in shared:
+        shared["project_context"] = project_context(shared["project_structure"], shared["content_store"])
+    return shared["project_context"]
+
+
+def _vector_store(shared):
+    """Spec embedding store persisted under the project (or VECTOR_STORE_DIR), opened once per run."""
+    if "vector_store" not in shared:
+        shared["vector_store"] = VectorStore(vector_store_dir(shared["repo_path"]))
+    return shared["vector_store"]
+
 class ProjectParserNode(Node):
     def exec(self, _):
         """Scans a repo for source files and the project for spec files."""
@@ -16,47 +49,17 @@ class ProjectParserNode(Node):
             raise NotADirectoryError(f"Path is not a valid directory: {repo_path}")
         self.repo_path = repo_path
 
-        excluded_dirs = ['/unity/', '/tests/']
-        all_c_files = glob.glob(os.path.join(repo_path, '**/*.c'), recursive=True)
-        source_files = []
-        for f in all_c_files:
-            normalized_path = f.replace('\\', '/')
-            if os.path.basename(normalized_path).startswith('test_'):
-                continue
-            if any(excluded in normalized_path for excluded in excluded_dirs):
-                continue
-            source_files.append(f)
-        
-        project_structure = {"sources": {}, "headers": {}, "specs": {}}
-        c_files = source_files
-        h_files = glob.glob(os.path.join(repo_path, '**/*.h'), recursive=True)
-        
-        spec_dir = 'specs'
-        spec_files = []
-        if os.path.isdir(spec_dir):
-            spec_files = glob.glob(os.path.join(spec_dir, '**/*.md'), recursive=True)
-            spec_files += glob.glob(os.path.join(spec_dir, '**/*.txt'), recursive=True)
-        
-        for spec_path in spec_files:
-            key = os.path.basename(spec_path)
-            with open(spec_path, 'r', encoding='utf-8') as f:
-                project_structure["specs"][key] = {"path": spec_path, "content": f.read()}
-
-        for h_path in h_files:
-            key = os.path.basename(h_path)
-            with open(h_path, 'r', encoding='utf-8') as f:
-                project_structure["headers"][key] = {"path": h_path, "content": f.read()}
-        for c_path in c_files:
-            key = os.path.basename(c_path)
-            with open(c_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                dependencies = [h for h in project_structure["headers"] if f'#include "{h}"' in content]
-                project_structure["sources"][key] = {"path": c_path, "content": content, "dependencies": dependencies}
+        # Only metadata is kept here; file text is read on demand through the ContentStore.
+        index_path = os.getenv("PROJECT_INDEX_PATH")
+        project_structure = scan_project(repo_path, previous=load_index(index_path))
+        if index_path:
+            save_index(index_path, [r for group in project_structure.values() for r in group.values()])
         return project_structure
 
     def post(self, shared, prep_res, exec_res):
         shared["project_structure"] = exec_res
         shared["repo_path"] = self.repo_path
+        shared.setdefault("content_store", ContentStore())
 
 
 # --- RENAMED: from TestCandidateSelectionNode ---
@@ -81,14 +84,117 @@ class CandidateSelectionNode(Node):
         return project_structure["sources"][selected_file]
     
     def post(self, shared, prep_res, exec_res):
-        shared["target_file"] = exec_res
+        # Only the selected module's text is materialized for the generation nodes.
+        shared["target_file"] = {
+            "path": exec_res.path,
+            "content": shared["content_store"].get(exec_res.path),
+            "dependencies": exec_res.dependencies,
+        }
+
+class ChangeDetectionNode(Node):
+    def prep(self, shared):
+        return {
+            "repo_path": shared["repo_path"],
+            "target_file": shared["target_file"],
+            "test_path": _test_file_path(shared["target_file"]["path"])
+        }
+
+    def exec(self, inputs):
+        """Offers a diff-based update when the source changed since its tests were generated."""
+        if not os.path.exists(inputs["test_path"]):
+            return None
+        baseline = load_baseline(inputs["repo_path"], inputs["target_file"]["path"])
+        if baseline is None or baseline == inputs["target_file"]["content"]:
+            return None
+
+        filename = os.path.basename(inputs["target_file"]["path"])
+        if prompt_for_confirmation(f"[path]{filename}[/path] changed since its tests were generated. Update the existing tests from the diff?"):
+            return baseline
+        return None
+
+    def post(self, shared, prep_res, exec_res):
+        if exec_res is None:
+            return "default"
+        shared["baseline_source"] = exec_res
+        return "update"
+
+
+class DiffUpdateNode(Node):
+    def prep(self, shared):
+        test_path = _test_file_path(shared["target_file"]["path"])
+        with open(test_path, 'r', encoding='utf-8') as f:
+            existing_tests = f.read()
+        return {
+            "baseline": shared["baseline_source"],
+            "target_content": shared["target_file"]["content"],
+            "target_filename": os.path.basename(shared["target_file"]["path"]),
+            "test_path": test_path,
+            "existing_tests": existing_tests,
+            "repo_path": shared["repo_path"],
+            "source_path": shared["target_file"]["path"],
+            "include_dirs": _include_dirs(shared),
+            "project_context": _project_context(shared)
+        }
+
+    def exec(self, inputs):
+        changes = diff_sources(inputs["baseline"], inputs["target_content"], inputs["target_filename"])
+        affected = changes["changed"] + changes["added"]
+        # Tests rarely call static helpers directly, so also match tests of the helpers' callers.
+        exercised = with_callers(inputs["target_content"], changes["changed"] + changes["removed"], changes["new_spans"])
+        tests = relevant_tests(inputs["existing_tests"], exercised)
+        tests_text = "\n\n".join(tests.values()) or "(none)"
+        sources_text = function_sources(inputs["target_content"], affected, changes["new_spans"]) or "(none)"
+
+        with status("Updating tests for the changed functions..."):
+            messages = build_messages(UPDATE_SYSTEM, UPDATE_USER.format(
+                filename=inputs["target_filename"], diff=changes["diff"], sources=sources_text, tests=tests_text
+            ), inputs.get("project_context"))
+            # Completion budget scales with the number of functions the diff touches.
+            touched = len(affected) + len(changes["removed"])
+            response = call_llm(messages, use_cache=False, max_tokens=min(4096, 512 + 384 * touched))
+
+        try:
+            patched, summary = apply_test_patch(inputs["existing_tests"], response)
+        except ValueError as e:
+            print_step(f"Could not apply the test update, keeping the existing tests: {e}")
+            return None
+
+        with open(inputs["test_path"], 'w', encoding='utf-8') as f:
+            f.write(patched)
+        try:
+            with status("Building the updated tests..."):
+                build_tests(inputs["repo_path"], inputs["source_path"], inputs["test_path"], inputs["include_dirs"])
+        except FileNotFoundError as e:
+            print_step(f"Could not verify that the updated tests build: {e}")
+        except RuntimeError as e:
+            print_step(f"Updated tests did not build, restoring the previous test file: {e}")
+            with open(inputs["test_path"], 'w', encoding='utf-8') as f:
+                f.write(inputs["existing_tests"])
+            return None
+
+        print_step(
+            f"Replaced {len(summary['replaced'])}, added {len(summary['added'])} and removed {len(summary['removed'])} tests."
+        )
+        return summary
+
+    def post(self, shared, prep_res, exec_res):
+        shared["test_file_path"] = prep_res["test_path"]
+        if exec_res is None:
+            shared["output_status"] = f"Existing tests kept in [path]{prep_res['test_path']}[/path]"
+            return
+        shared["maintenance_summary"] = exec_res
+        shared["output_status"] = f"Tests updated in [path]{prep_res['test_path']}[/path]"
+        save_baseline(shared["repo_path"], shared["target_file"]["path"], shared["target_file"]["content"])
+
 
-# ... (RequirementExtractionNode is unchanged) ...
 class RequirementExtractionNode(Node):
     def prep(self, shared):
         return {
             "target_filename": os.path.basename(shared["target_file"]["path"]),
-            "specs": shared["project_structure"]["specs"]
+            "specs": shared["project_structure"]["specs"],
+            "content_store": shared["content_store"],
+            "embedding_cache": shared.setdefault("embedding_cache", {}),
+            "vector_store": _vector_store(shared)
         }
 
     def exec(self, inputs):
@@ -100,21 +206,25 @@ class RequirementExtractionNode(Node):
         with status("Analyzing requirements..."):
             target_filename = inputs["target_filename"]
             query = f"What are the functional and error-handling requirements for the code in {target_filename}?"
-            query_embedding = get_embedding(query)
-            spec_contents = [doc["content"] for doc in specs.values()]
-            spec_embeddings = [get_embedding(doc) for doc in spec_contents]
-
-            if not spec_embeddings:
-                return "No specific requirements found."
-
-            similarities = cosine_similarity([query_embedding], spec_embeddings)[0]
-            most_relevant_idx = np.argmax(similarities)
-            
-            if similarities[most_relevant_idx] < 0.3:
+            store = inputs["content_store"]
+            cache = inputs.get("embedding_cache", {})
+            if query not in cache:
+                cache[query] = get_embedding(query)
+
+            # Spec vectors are persisted per path with their digest, so only new or edited specs are embedded.
+            vectors = inputs["vector_store"]
+            vectors.sync(
+                [(record.path, record.digest) for record in specs.values()],
+                lambda path: get_embedding(store.get(path)),
+                model=os.getenv("EMBEDDING_MODEL", "mxbai-embed-large")
+            )
+            matches = vectors.search(cache[query], k=1)
+
+            if not matches or matches[0][0] < 0.3:
                 return "No specific requirements found."
             
             print_step("Found relevant requirements.")
-            return spec_contents[most_relevant_idx]
+            return store.get(matches[0][1])
 
     def post(self, shared, prep_res, exec_res):
         shared["relevant_requirements"] = exec_res
@@ -125,28 +235,16 @@ class PlanGeneratorNode(Node):
         return {
             "target_content": shared["target_file"]["content"],
             "target_filename": os.path.basename(shared["target_file"]["path"]),
-            "requirements": shared.get("relevant_requirements", "No specific requirements provided.")
+            "requirements": shared.get("relevant_requirements", "No specific requirements provided."),
+            "project_context": _project_context(shared)
         }
 
     def exec(self, inputs):
         with status("Generating a test plan for your review..."):
-            prompt = f"""
-            You are a senior C software test engineer. Your task is to create a test plan for the C source file `{inputs['target_filename']}`.
-
-            Analyze the provided source code and functional requirements, then create a clear, concise test plan in Markdown format.
-            For each function in the source file, list the specific test cases you will create. Each test case should be a bullet point describing its purpose (e.g., testing success, error handling, edge cases).
-
-            ### Functional Requirements ###
-            {inputs['requirements']}
-
-            ### Source Code to Plan For ###
-            ```c
-            {inputs['target_content']}
-            ```
-
-            Return ONLY the Markdown test plan. Do not write any C code yet.
-            """
-            response = call_llm(prompt, use_cache=False)
+            messages = build_messages(PLAN_SYSTEM, PLAN_USER.format(
+                filename=inputs["target_filename"], requirements=inputs["requirements"], source=inputs["target_content"]
+            ), inputs.get("project_context"))
+            response = call_llm(messages, use_cache=False)
         print_step("Test plan generated.")
         return response
 
@@ -177,34 +275,19 @@ class ContextualTestGeneratorNode(Node):
         return {
             "target_content": shared["target_file"]["content"],
             "target_filename": os.path.basename(shared["target_file"]["path"]),
-            "approved_plan": shared["test_plan"]
+            "approved_plan": shared["test_plan"],
+            "headers": shared["target_file"]["dependencies"],
+            "project_context": _project_context(shared)
         }
     
     def exec(self, inputs):
         console.print("\n[info]This next step involves a large request to the AI and may take a few minutes. Please be patient...[/info]")
         with status("Generating test code based on the approved plan..."):
-            prompt = f"""
-            You are an expert C unit testing engineer. Your task is to write a complete C test file that implements the following approved test plan for the source code in `{inputs['target_filename']}`.
-
-            **Implement this EXACT test plan:**
-            {inputs['approved_plan']}
-
-            **Base the tests on this source code:**
-            ```c
-            {inputs['target_content']}
-            ```
-            
-            **CRITICAL INSTRUCTIONS:**
-            1.  Write a complete C file containing Unity tests. The code must be complete and syntactically correct.
-            2.  Include the necessary headers: `#include "unity.h"`, `#include "spi.h"`.
-            3.  **To access the internal state for testing, you MUST declare the global variables from `spi.c` as `extern`. Add these lines at the top of the test file:**
-                ```c
-                extern spi_state_t g_spi_state;
-                extern spi_config_t g_spi_config;
-                ```
-            4.  Implement the `setUp()` function to reset the state before each test.
-            """
-            response = call_llm(prompt, max_tokens=4096)
+            messages = build_messages(GENERATE_SYSTEM, GENERATE_USER.format(
+                filename=inputs["target_filename"], headers=", ".join(inputs.get("headers", [])) or "none",
+                plan=inputs["approved_plan"], source=inputs["target_content"]
+            ), inputs.get("project_context"))
+            response = call_llm(messages, max_tokens=4096, complete_check=is_c_code_complete)
         print_step("Initial draft generated.")
         return response
 
@@ -214,28 +297,12 @@ class ContextualTestGeneratorNode(Node):
 
 class FinalReviewerNode(Node):
     def prep(self, shared):
-        return {"generated_code": shared["generated_tests"]}
+        return {"generated_code": shared["generated_tests"], "project_context": _project_context(shared)}
 
     def exec(self, inputs):
         with status("Performing final syntax and structural review..."):
-            review_prompt = f"""
-            You are a C language syntax checker and fixer. Your only job is to ensure the following code is valid, compilable C.
-
-            **Code to fix:**
-            ```c
-            {inputs['generated_code']}
-            ```
-
-            **Fix these common errors:**
-            1.  **Completeness:** Ensure no functions are left unfinished. Check for hanging curly braces or incomplete statements.
-            2.  **Includes:** Ensure necessary headers like `unity.h`, `spi.h`, `<stdlib.h>` are included.
-            3.  **Global Variable Access:** Ensure the test file declares `extern spi_state_t g_spi_state;` and `extern spi_config_t g_spi_config;` at the top level to access the module's internal state.
-            4.  **Struct Initializers:** Ensure all `spi_config_t` structs are initialized using designated initializers, like `spi_config_t my_config = {{.mode = 0, .speed_hz = 1000000}};`. This prevents overflow warnings.
-            5.  **Mandatory Functions:** Ensure `setUp(void)`, `tearDown(void)`, and a `main` function with `RUN_TEST` calls exist.
-
-            Return ONLY the complete, corrected C code in a single markdown block.
-            """
-            response = call_llm(review_prompt, use_cache=False, max_tokens=4096)
+            messages = build_messages(REVIEW_SYSTEM, REVIEW_USER.format(code=inputs["generated_code"]), inputs.get("project_context"))
+            response = call_llm(messages, use_cache=False, max_tokens=4096, complete_check=is_c_code_complete)
         print_step("Final review complete.")
         return response
 
@@ -245,11 +312,7 @@ class FinalReviewerNode(Node):
 
 class FileWriterNode(Node):
     def prep(self, shared):
-        original_path = shared["target_file"]["path"]
-        dir_name = os.path.dirname(original_path)
-        base_name = os.path.basename(original_path)
-        base, ext = os.path.splitext(base_name)
-        test_filename = os.path.join(dir_name, f"test_{base}.c")
+        test_filename = _test_file_path(shared["target_file"]["path"])
         
         if os.path.exists(test_filename):
             if not prompt_for_confirmation(f"[warning]File [path]{test_filename}[/path] already exists. Overwrite?[/warning]", default=False):
@@ -262,12 +325,7 @@ class FileWriterNode(Node):
         filename = inputs["filename"]
         content = inputs["content"]
         
-        if "```c" in content:
-            parts = content.split("```c")
-            if len(parts) > 1:
-                content = parts[1].split("```")[0]
-        
-        content = content.strip()
+        content = extract_c_code(content).strip()
             
         with open(filename, 'w', encoding='utf-8') as f:
             f.write(content)
@@ -276,6 +334,9 @@ class FileWriterNode(Node):
 
     def post(self, shared, prep_res, exec_res):
         shared["output_status"] = exec_res
+        shared["test_file_path"] = prep_res["filename"]
+        # Snapshot the source the tests were generated from so later edits can be diffed.
+        save_baseline(shared["repo_path"], shared["target_file"]["path"], shared["target_file"]["content"])
 
 class MakefileGeneratorNode(Node):
     def prep(self, shared):
@@ -334,4 +395,100 @@ clean:
         return f"Makefile generated at [path]{makefile_path}[/path]"
     
     def post(self, shared, prep_res, exec_res):
-        shared["makefile_status"] = exec_res
\ No newline at end of file
+        shared["makefile_status"] = exec_res
+
+
+class CoverageTopUpNode(Node):
+    def prep(self, shared):
+        return {
+            "repo_path": shared["repo_path"],
+            "source_path": shared["target_file"]["path"],
+            "test_path": shared["test_file_path"],
+            "target_filename": os.path.basename(shared["target_file"]["path"]),
+            "include_dirs": _include_dirs(shared),
+            "project_context": _project_context(shared)
+        }
+
+    def exec(self, inputs):
+        """Measures gcov coverage and asks the LLM only for tests that close the remaining gaps."""
+        build_args = (inputs["repo_path"], inputs["source_path"], inputs["test_path"], inputs["include_dirs"])
+        try:
+            with status("Measuring coverage of the generated tests..."):
+                before = measure_coverage(*build_args)
+        except (FileNotFoundError, RuntimeError) as e:
+            print_step(f"Skipping coverage top-up: {e}")
+            return None
+
+        gaps = uncovered_functions(before)
+        report = {"before": before, "after": before, "added_tests": [], "tokens": 0}
+        if not gaps:
+            print_step("All lines and branches are already covered.")
+            return report
+
+        with open(inputs["test_path"], 'r', encoding='utf-8') as f:
+            existing = f.read()
+
+        gap_sections = []
+        for name, info in gaps.items():
+            excerpt = "\n".join(info["excerpt"])
+            gap_sections.append(
+                f"#### `{name}` (uncovered lines: {info['uncovered_lines']}, untaken branches on lines: {sorted(set(info['uncovered_branches']))})\n"
+                f"```\n{excerpt}\n```"
+            )
+        gap_text = "\n\n".join(gap_sections)
+
+        with status("Generating additional tests for uncovered code..."):
+            messages = build_messages(TOP_UP_SYSTEM, TOP_UP_USER.format(
+                filename=inputs["target_filename"], gaps=gap_text,
+                existing_tests=", ".join(extract_test_functions(existing)) or "none"
+            ), inputs.get("project_context"))
+            tokens_before = token_usage["prompt_tokens"] + token_usage["completion_tokens"]
+            response = call_llm(messages, use_cache=False, max_tokens=2048)
+            report["tokens"] = token_usage["prompt_tokens"] + token_usage["completion_tokens"] - tokens_before
+
+        try:
+            merged, report["added_tests"] = merge_test_functions(existing, response)
+        except ValueError as e:
+            print_step(f"Skipping coverage top-up: {e}")
+            return report
+        if not report["added_tests"]:
+            print_step("The model did not return any new test functions.")
+            return report
+
+        with open(inputs["test_path"], 'w', encoding='utf-8') as f:
+            f.write(merged)
+        try:
+            with status("Re-measuring coverage..."):
+                after = measure_coverage(*build_args)
+        except RuntimeError as e:
+            print_step(f"Top-up tests did not build, restoring the previous test file: {e}")
+            after = None
+        else:
+            failing = [name for name in report["added_tests"] if name in after["failed_tests"]]
+            if failing or (before["tests_passed"] and not after["tests_passed"]):
+                print_step(f"Top-up tests failed ({', '.join(failing) or 'test runner exited with an error'}), restoring the previous test file.")
+                after = None
+        if after is None:
+            with open(inputs["test_path"], 'w', encoding='utf-8') as f:
+                f.write(existing)
+            report["added_tests"] = []
+        else:
+            report["after"] = after
+        return report
+
+    def post(self, shared, prep_res, exec_res):
+        if exec_res is None:
+            shared["coverage_status"] = "Coverage top-up skipped."
+            return
+        before, after = exec_res["before"], exec_res["after"]
+        gained = after["line_percent"] - before["line_percent"]
+        summary = (
+            f"Coverage {before['line_percent']}% -> {after['line_percent']}% lines, "
+            f"{before['branch_percent']}% -> {after['branch_percent']}% branches "
+            f"({len(exec_res['added_tests'])} tests added"
+        )
+        if exec_res["tokens"]:
+            summary += f", {gained * 1000 / exec_res['tokens']:.2f} line-% per 1k tokens"
+        shared["coverage_report"] = exec_res
+        shared["coverage_status"] = summary + ")"
+
@@ -0,0 +1,150 @@
+"""
+Prompt templates for the LLM nodes.
+
+Every prompt is laid out so that its beginning is identical across modules:
+the static instructions form the system message, the user message opens with
+the shared project context, and per-module content (file names, source,
+plans, diffs) always comes last. This lets the provider's prefix cache apply
+across every module in a batch run.
+"""
+
+UNITY_CONVENTIONS = """### Unity Conventions ###
+- Tests are `void test_<name>(void)` functions that use the `TEST_ASSERT_*` macros from `unity.h`.
+- `setUp(void)` runs before every test and `tearDown(void)` after it; both must be defined.
+- `main` calls `UNITY_BEGIN()`, then one `RUN_TEST(test_<name>);` per test, and returns `UNITY_END()`.
+- Tests are built with `gcc -std=c99 -Wall -Wextra -pedantic -DTEST`. `-DTEST` makes module globals non-static so tests can declare them `extern`.
+- Structs are initialized with designated initializers, e.g. `spi_config_t cfg = {.mode = 0, .speed_hz = 1000000};`."""
+
+PLAN_SYSTEM = """You are a senior C software test engineer. Your task is to create a test plan for a C source file.
+
+Analyze the provided source code and functional requirements, then create a clear, concise test plan in Markdown format.
+For each function in the source file, list the specific test cases you will create. Each test case should be a bullet point describing its purpose (e.g., testing success, error handling, edge cases).
+
+Return ONLY the Markdown test plan. Do not write any C code yet."""
+
+PLAN_USER = """### Source File ###
+`{filename}`
+
+### Functional Requirements ###
+{requirements}
+
+### Source Code to Plan For ###
+```c
+{source}
+```"""
+
+GENERATE_SYSTEM = """You are an expert C unit testing engineer. Your task is to write a complete C test file that implements an approved test plan for a C source file.
+
+**CRITICAL INSTRUCTIONS:**
+1.  Write a complete C file containing Unity tests. The code must be complete and syntactically correct.
+2.  Include `#include "unity.h"` and the module's own headers listed with the source.
+3.  **To access the internal state for testing, you MUST declare the module's global variables as `extern` at the top of the test file**, for example:
+    ```c
+    extern spi_state_t g_spi_state;
+    extern spi_config_t g_spi_config;
+    ```
+4.  Implement the `setUp()` function to reset the state before each test.
+5.  Implement EXACTLY the approved test plan."""
+
+GENERATE_USER = """### Source File ###
+`{filename}` (headers: {headers})
+
+**Implement this EXACT test plan:**
+{plan}
+
+**Base the tests on this source code:**
+```c
+{source}
+```"""
+
+REVIEW_SYSTEM = """You are a C language syntax checker and fixer. Your only job is to ensure the given Unity test file is valid, compilable C.
+
+**Fix these common errors:**
+1.  **Completeness:** Ensure no functions are left unfinished. Check for hanging curly braces or incomplete statements.
+2.  **Includes:** Ensure necessary headers like `unity.h`, the module's header and `<stdlib.h>` are included.
+3.  **Global Variable Access:** Ensure the test file declares the module's internal state (e.g. `extern spi_state_t g_spi_state;` and `extern spi_config_t g_spi_config;`) at the top level.
+4.  **Struct Initializers:** Ensure all config structs are initialized using designated initializers, like `spi_config_t my_config = {.mode = 0, .speed_hz = 1000000};`. This prevents overflow warnings.
+5.  **Mandatory Functions:** Ensure `setUp(void)`, `tearDown(void)`, and a `main` function with `RUN_TEST` calls exist.
+
+Return ONLY the complete, corrected C code in a single markdown block."""
+
+REVIEW_USER = """**Code to fix:**
+```c
+{code}
+```"""
+
+TOP_UP_SYSTEM = """You are an expert C unit testing engineer. An existing Unity test file leaves parts of its module uncovered.
+Each excerpt you are given is gcov output: lines marked `#####` were never executed.
+
+**CRITICAL INSTRUCTIONS:**
+1.  Write ONLY new `void test_<name>(void)` Unity test functions that execute the uncovered lines and branches.
+2.  Do NOT repeat includes, `extern` declarations, `setUp`, `tearDown` or `main`.
+3.  Assume `setUp()` resets the module state before each test.
+4.  Do not reuse any existing test name.
+
+Return ONLY the new test functions in a single C markdown block."""
+
+TOP_UP_USER = """### Source File ###
+`{filename}`
+
+### Uncovered Code ###
+{gaps}
+
+**Existing test names (do not reuse):** {existing_tests}"""
+
+UPDATE_SYSTEM = """You are an expert C unit testing engineer maintaining an existing Unity test file.
+The module's source changed. Update the tests to match the change only.
+
+**CRITICAL INSTRUCTIONS:**
+1.  Return a patch made of complete `void test_<name>(void)` functions. A function with an existing name replaces that test; a new name adds a test.
+2.  To delete an obsolete test, emit a line `// REMOVE: test_<name>`.
+3.  Do NOT return includes, `extern` declarations, `setUp`, `tearDown`, `main` or unchanged tests.
+
+Return ONLY the patch in a single C markdown block."""
+
+UPDATE_USER = """### Source File ###
+`{filename}`
+
+### Source Diff ###
+```diff
+{diff}
+```
+
+### Current Definitions of Changed/Added Functions ###
+```c
+{sources}
+```
+
+### Existing Tests Exercising the Changed/Removed Functions ###
+```c
+{tests}
+```"""
+
+
+def project_context(project_structure: dict, content_store, max_chars: int = 8000) -> str:
+    """
+    Shared context that is byte-identical for every module in a project: the
+    Unity conventions plus headers included by two or more source files.
+    """
+    usage = {}
+    for record in project_structure["sources"].values():
+        for header in record.dependencies:
+            usage[header] = usage.get(header, 0) + 1
+
+    sections = [UNITY_CONVENTIONS]
+    budget = max_chars
+    for name in sorted(h for h, count in usage.items() if count >= 2):
+        text = f"#### {name} ####\n```c\n{content_store.get(project_structure['headers'][name].path)}\n```"
+        if len(text) > budget:
+            break
+        sections.append(text)
+        budget -= len(text)
+    if len(sections) > 1:
+        sections.insert(1, "### Common Project Headers ###")
+    return "\n\n".join(sections)
+
+
+def build_messages(system: str, user: str, context: str = None) -> list:
+    """Static system instructions first, then shared project context, then per-module content."""
+    content = f"{context}\n\n{user}" if context else user
+    return [{"role": "system", "content": system}, {"role": "user", "content": content}]
@@ -0,0 +1,20 @@
+import os
+import json
+import socket
+
+# Kept free of pipeline imports so `main.py rpc` does not pay the daemon's startup cost.
+DEFAULT_SOCKET = os.getenv("CIRKITLY_SOCKET", "/tmp/cirkitly.sock")
+
+
+def rpc_call(method: str, params: dict = None, socket_path: str = DEFAULT_SOCKET, timeout: float = None):
+    """Sends one request to a running daemon and returns its result, raising on an RPC error."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as reader:
+            response = json.loads(reader.readline())
+    if "error" in response:
+        raise RuntimeError(f"RPC error {response['error']['code']}: {response['error']['message']}")
+    return response["result"]
@@ -0,0 +1,103 @@
+import os
+import threading
+import pytest
+
+from daemon import CirkitlyDaemon, _RpcServer, _RpcHandler
+from rpc_client import rpc_call
+from utils.source_diff import save_baseline
+
+
+@pytest.fixture
+def c_project(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "spi.c").write_text('#include "spi.h"\nint spi_init(void) { return 0; }\n')
+    (tmp_path / "spi.h").write_text("int spi_init(void);\n")
+    return tmp_path
+
+
+def test_daemon_refresh_picks_up_changed_and_new_files(c_project):
+    """Verify only modified or added files are reported and their cached text is dropped."""
+    daemon = CirkitlyDaemon(str(c_project), spec_dir=str(c_project / "specs"))
+    spi_path = str(c_project / "src" / "spi.c")
+    daemon.content_store.get(spi_path)
+
+    (c_project / "src" / "spi.c").write_text('#include "spi.h"\nint spi_init(void) { return 1; }\n')
+    os.utime(spi_path, (1, 1))
+    (c_project / "src" / "i2c.c").write_text("int i2c_init(void) { return 0; }\n")
+
+    changed = daemon.refresh()
+
+    assert sorted(os.path.basename(p) for p in changed) == ["i2c.c", "spi.c"]
+    assert "return 1;" in daemon.content_store.get(spi_path)
+    assert daemon.content_store.misses == 2
+
+
+def test_daemon_dispatch_plan_and_errors(mocker, c_project):
+    """Verify JSON-RPC dispatch runs the plan nodes and maps errors to codes."""
+    daemon = CirkitlyDaemon(str(c_project), spec_dir=str(c_project / "specs"))
+    mocker.patch("nodes.call_llm", return_value="- test spi_init")
+
+    response = daemon.dispatch('{"jsonrpc": "2.0", "id": 7, "method": "plan", "params": {"file": "spi.c"}}')
+
+    assert response["id"] == 7
+    assert response["result"]["plan"] == "- test spi_init"
+    assert daemon.dispatch('{"id": 1, "method": "nope"}')["error"]["code"] == -32601
+    assert daemon.dispatch('{"id": 2, "method": "plan", "params": {"file": "x.c"}}')["error"]["code"] == -32602
+    assert daemon.dispatch('{"id": 3, "method": "plan", "params": {}}')["error"]["code"] == -32602
+    assert daemon.dispatch("not json")["error"]["code"] == -32700
+    assert daemon.dispatch("[1, 2]")["error"]["code"] == -32600
+    assert daemon.dispatch("5")["error"]["code"] == -32600
+
+
+def test_daemon_dispatch_reports_pipeline_key_errors_as_server_errors(mocker, c_project):
+    """Verify a KeyError raised inside the nodes is not mistaken for bad params."""
+    daemon = CirkitlyDaemon(str(c_project), spec_dir=str(c_project / "specs"))
+    mocker.patch("nodes.call_llm", side_effect=KeyError("choices"))
+
+    response = daemon.dispatch('{"id": 4, "method": "plan", "params": {"file": "spi.c"}}')
+
+    assert response["error"]["code"] == -32000
+
+
+def test_rpc_call_round_trip_over_unix_socket(c_project, tmp_path):
+    """Verify a client can query status over the Unix socket."""
+    daemon = CirkitlyDaemon(str(c_project), spec_dir=str(c_project / "specs"))
+    socket_path = str(tmp_path / "cirkitly.sock")
+    with _RpcServer(socket_path, _RpcHandler) as server:
+        server.cirkitly = daemon
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            result = rpc_call("status", socket_path=socket_path, timeout=5)
+        finally:
+            server.shutdown()
+
+    assert result["sources"] == ["spi.c"]
+    assert result["files"]["headers"] == 1
+
+
+def test_daemon_generate_does_not_overwrite_existing_tests(mocker, c_project):
+    """Verify an existing test file is refused, updated from the diff, or replaced only on request."""
+    daemon = CirkitlyDaemon(str(c_project), spec_dir=str(c_project / "specs"))
+    test_file = c_project / "src" / "test_spi.c"
+    test_file.write_text("// hand-edited tests\n")
+    mock_llm = mocker.patch("nodes.call_llm", return_value="```c\nint main(void) { return 0; }\n```")
+    mock_update = mocker.patch("daemon.DiffUpdateNode")
+
+    response = daemon.dispatch('{"id": 1, "method": "generate", "params": {"file": "spi.c"}}')
+
+    assert response["error"]["code"] == -32602
+    assert test_file.read_text() == "// hand-edited tests\n"
+    mock_llm.assert_not_called()
+
+    save_baseline(str(c_project), str(c_project / "src" / "spi.c"), "int spi_init(void) { return 1; }\n")
+    response = daemon.dispatch('{"id": 2, "method": "generate", "params": {"file": "spi.c"}}')
+
+    assert "result" in response
+    mock_update.return_value.run.assert_called_once()
+    assert test_file.read_text() == "// hand-edited tests\n"
+
+    response = daemon.dispatch('{"id": 3, "method": "generate", "params": {"file": "spi.c", "overwrite": true}}')
+
+    assert response["result"]["test_file"] == str(test_file)
+    assert test_file.read_text() == "int main(void) { return 0; }"
@@ -6,9 +6,19 @@ from nodes import (
     CandidateSelectionNode,  # Corrected name
     PlanGeneratorNode,       # Corrected name
     HumanApprovalNode,
+    RequirementExtractionNode,
     ContextualTestGeneratorNode,
     FileWriterNode,
+    CoverageTopUpNode,
+    DiffUpdateNode,
 )
+from utils.project_index import FileRecord
+from utils.vector_store import VectorStore
+
+def _prompt_text(mock_llm):
+    """Joins the chat messages passed to a mocked call_llm into one string."""
+    return "\n".join(message["content"] for message in mock_llm.call_args[0][0])
+
 
 # A reusable fixture that provides a mock project structure for multiple tests.
 @pytest.fixture
@@ -16,20 +26,12 @@ def mock_shared_state():
     return {
         "project_structure": {
             "sources": {
-                "spi.c": {
-                    "path": "my_c_project/src/spi.c",
-                    "content": "int spi_init() { return 0; }",
-                    "dependencies": ["spi.h"]
-                },
-                "i2c.c": {
-                    "path": "my_c_project/src/i2c.c",
-                    "content": "int i2c_init() { return 0; }",
-                    "dependencies": ["i2c.h"]
-                }
+                "spi.c": FileRecord("my_c_project/src/spi.c", 28, 0.0, "a1", ["spi.h"], ["spi.h"]),
+                "i2c.c": FileRecord("my_c_project/src/i2c.c", 28, 0.0, "b2", ["i2c.h"], ["i2c.h"])
             },
             "headers": {
-                "spi.h": {"path": "my_c_project/include/spi.h", "content": "#define SPI_OK 0"},
-                "i2c.h": {"path": "my_c_project/include/i2c.h", "content": "#define I2C_OK 0"}
+                "spi.h": FileRecord("my_c_project/include/spi.h", 17, 0.0, "c3"),
+                "i2c.h": FileRecord("my_c_project/include/i2c.h", 17, 0.0, "d4")
             },
             "specs": {}
         },
@@ -37,26 +39,22 @@ def mock_shared_state():
     }
 
 # --- Test ProjectParserNode ---
-@patch("nodes.glob")
-@patch("nodes.os.path.isdir", return_value=True)
-@patch("nodes.prompt_for_input", return_value="my_c_project")
-def test_project_parser_node(mock_prompt, mock_isdir, mock_glob):
-    """Verify the project parser correctly finds and reads files."""
+@patch("nodes.prompt_for_input")
+def test_project_parser_node(mock_prompt, tmp_path):
+    """Verify the project parser records metadata and dependencies without keeping file text."""
+    (tmp_path / "src").mkdir()
+    (tmp_path / "include").mkdir()
+    (tmp_path / "src" / "spi.c").write_text('// Mocked file content\n#include "spi.h"\n')
+    (tmp_path / "include" / "spi.h").write_text("#define SPI_OK 0\n")
+    mock_prompt.return_value = str(tmp_path)
     node = ProjectParserNode()
-    mock_glob.glob.side_effect = [
-        ["my_c_project/src/spi.c"],
-        ["my_c_project/include/spi.h"],
-        [],
-        []
-    ]
-    m = mock_open(read_data='// Mocked file content\n#include "spi.h"')
-    
-    with patch("builtins.open", m):
-        result = node.exec(None)
+
+    result = node.exec(None)
 
     assert "spi.c" in result["sources"]
     assert "spi.h" in result["headers"]
-    assert result["sources"]["spi.c"]["dependencies"] == ["spi.h"]
+    assert result["sources"]["spi.c"].dependencies == ["spi.h"]
+    assert not hasattr(result["sources"]["spi.c"], "__dict__")
 
 
 # --- Test CandidateSelectionNode ---
@@ -67,7 +65,32 @@ def test_candidate_selection_node(mocker, mock_shared_state):
     
     selected_file = node.exec(mock_shared_state["project_structure"])
     
-    assert selected_file["path"] == "my_c_project/src/i2c.c"
+    assert selected_file.path == "my_c_project/src/i2c.c"
+
+
+# --- Test RequirementExtractionNode ---
+def test_requirement_extraction_embeds_each_spec_once(mocker, tmp_path):
+    """Verify the best-matching spec is returned and unchanged specs are not re-embedded."""
+    node = RequirementExtractionNode()
+    embeddings = {"query": [1.0, 0.0], "spi spec": [0.9, 0.1], "i2c spec": [0.0, 1.0]}
+    mock_embed = mocker.patch("nodes.get_embedding", side_effect=lambda text: embeddings["query" if "requirements" in text else text])
+    store = MagicMock()
+    store.get.side_effect = lambda path: {"specs/spi.md": "spi spec", "specs/i2c.md": "i2c spec"}[path]
+    inputs = {
+        "target_filename": "spi.c",
+        "specs": {
+            "spi.md": FileRecord("specs/spi.md", 8, 0.0, "d-spi"),
+            "i2c.md": FileRecord("specs/i2c.md", 8, 0.0, "d-i2c"),
+        },
+        "content_store": store,
+        "embedding_cache": {},
+        "vector_store": VectorStore(str(tmp_path)),
+    }
+
+    assert node.exec(inputs) == "spi spec"
+    inputs["vector_store"] = VectorStore(str(tmp_path))
+    assert node.exec(inputs) == "spi spec"
+    assert mock_embed.call_count == 3
 
 
 # --- Test PlanGeneratorNode ---
@@ -84,12 +107,33 @@ def test_plan_generator_node(mocker):
     node.exec(inputs)
     
     mock_llm.assert_called_once()
-    prompt_arg = mock_llm.call_args[0][0]
+    prompt_arg = _prompt_text(mock_llm)
     assert "int main() {}" in prompt_arg
     assert "main.c" in prompt_arg
     assert "Must work." in prompt_arg
 
 
+def test_plan_prompts_share_a_cacheable_prefix(mocker, mock_shared_state):
+    """Verify per-module content comes after an identical system message and project context."""
+    mock_llm = mocker.patch("nodes.call_llm", return_value="plan")
+    shared = dict(mock_shared_state, content_store=MagicMock(), relevant_requirements="Must work.")
+    node = PlanGeneratorNode()
+    prompts = []
+    for name in ("spi.c", "i2c.c"):
+        record = shared["project_structure"]["sources"][name]
+        shared["target_file"] = {"path": record.path, "content": f"int {name[:-2]}_init(void);", "dependencies": []}
+        node.exec(node.prep(shared))
+        prompts.append(mock_llm.call_args[0][0])
+
+    system_a, user_a = prompts[0]
+    system_b, user_b = prompts[1]
+    assert system_a == system_b and system_a["role"] == "system"
+    assert "spi.c" not in system_a["content"]
+    context = shared["project_context"]
+    assert user_a["content"].startswith(context) and user_b["content"].startswith(context)
+    assert user_a["content"].index("spi.c") > len(context)
+
+
 # --- Test HumanApprovalNode ---
 def test_human_approval_node_approves(mocker):
     """Verify flow continues when user approves."""
@@ -149,4 +193,134 @@ def test_file_writer_node_stops_on_overwrite_rejection(mocker):
         "generated_tests": "some code"
     })
     
-    assert node.flow_control.stop_flow is True
\ No newline at end of file
+    assert node.flow_control.stop_flow is True
+
+
+# --- Test CoverageTopUpNode ---
+def test_coverage_top_up_prompts_only_for_uncovered_functions(mocker, tmp_path):
+    """Verify only uncovered functions are sent to the LLM and new tests are merged."""
+    node = CoverageTopUpNode()
+    test_file = tmp_path / "test_spi.c"
+    test_file.write_text("int main(void) {\n    UNITY_BEGIN();\n    return UNITY_END();\n}\n")
+    gap = {"excerpt": ["#####:   20:  return 1;"], "uncovered_lines": [20], "uncovered_branches": []}
+    covered = {"excerpt": ["1:   30:  return 0;"], "uncovered_lines": [], "uncovered_branches": []}
+    before = {"line_percent": 50.0, "branch_percent": 50.0, "tests_passed": True, "failed_tests": [],
+              "functions": {"spi_init": gap, "spi_get_state": covered}}
+    after = {"line_percent": 100.0, "branch_percent": 100.0, "tests_passed": True, "failed_tests": [], "functions": {}}
+    mocker.patch("nodes.measure_coverage", side_effect=[before, after])
+    mock_llm = mocker.patch("nodes.call_llm", return_value="```c\nvoid test_init_twice(void) {\n}\n```")
+
+    report = node.exec({
+        "repo_path": str(tmp_path), "source_path": "spi.c", "test_path": str(test_file),
+        "target_filename": "spi.c", "include_dirs": []
+    })
+
+    prompt_arg = _prompt_text(mock_llm)
+    assert "spi_init" in prompt_arg
+    assert "spi_get_state" not in prompt_arg
+    assert report["added_tests"] == ["test_init_twice"]
+    assert "RUN_TEST(test_init_twice);" in test_file.read_text()
+
+
+def test_coverage_top_up_restores_file_when_new_tests_fail(mocker, tmp_path):
+    """Verify top-up tests that build but fail at runtime are not kept."""
+    node = CoverageTopUpNode()
+    original = "int main(void) {\n    UNITY_BEGIN();\n    return UNITY_END();\n}\n"
+    test_file = tmp_path / "test_spi.c"
+    test_file.write_text(original)
+    gap = {"excerpt": ["#####:   20:  return 1;"], "uncovered_lines": [20], "uncovered_branches": []}
+    before = {"line_percent": 50.0, "branch_percent": 50.0, "tests_passed": True, "failed_tests": [], "functions": {"spi_init": gap}}
+    after = {"line_percent": 100.0, "branch_percent": 100.0, "tests_passed": False, "failed_tests": ["test_init_twice"], "functions": {}}
+    mocker.patch("nodes.measure_coverage", side_effect=[before, after])
+    mocker.patch("nodes.call_llm", return_value="```c\nvoid test_init_twice(void) {\n}\n```")
+
+    report = node.exec({
+        "repo_path": str(tmp_path), "source_path": "spi.c", "test_path": str(test_file),
+        "target_filename": "spi.c", "include_dirs": []
+    })
+
+    assert report["added_tests"] == []
+    assert report["after"] is before
+    assert test_file.read_text() == original
+
+
+# --- Test DiffUpdateNode ---
+def test_diff_update_node_sends_only_the_change(mocker, tmp_path):
+    """Verify the update prompt carries the diff and affected tests, not the whole module."""
+    node = DiffUpdateNode()
+    test_file = tmp_path / "test_spi.c"
+    test_file.write_text(
+        "void test_init(void) {\n    spi_init();\n}\n\nvoid test_unrelated(void) {\n    spi_other();\n}\n\n"
+        "int main(void) {\n    UNITY_BEGIN();\n    return UNITY_END();\n}\n"
+    )
+    baseline = "int spi_init(void) {\n    return 0;\n}\n\nint spi_other(void) {\n    return UNCHANGED_BODY;\n}\n"
+    current = baseline.replace("    return 0;", "    return 1;")
+    mock_llm = mocker.patch("nodes.call_llm", return_value="```c\nvoid test_init(void) {\n    spi_init_v2();\n}\n```")
+    mocker.patch("nodes.build_tests")
+
+    summary = node.exec({
+        "baseline": baseline, "target_content": current, "target_filename": "spi.c",
+        "test_path": str(test_file), "existing_tests": test_file.read_text(),
+        "repo_path": str(tmp_path), "source_path": "spi.c", "include_dirs": []
+    })
+
+    prompt_arg = _prompt_text(mock_llm)
+    assert "+    return 1;" in prompt_arg
+    assert "UNCHANGED_BODY" not in prompt_arg
+    assert "test_unrelated" not in prompt_arg
+    assert mock_llm.call_args[1]["max_tokens"] < 4096
+    assert summary["replaced"] == ["test_init"]
+    assert "spi_init_v2();" in test_file.read_text()
+
+
+def test_diff_update_node_includes_tests_of_static_helper_callers(mocker, tmp_path):
+    """Verify a change to a static helper selects the tests of the public functions calling it."""
+    node = DiffUpdateNode()
+    existing = (
+        "void test_set_config_rejects_16mhz(void) {\n    TEST_ASSERT_EQUAL(SPI_ERROR, spi_set_config(&cfg));\n}\n\n"
+        "void test_unrelated(void) {\n    spi_get_state();\n}\n\n"
+        "int main(void) {\n    UNITY_BEGIN();\n    return UNITY_END();\n}\n"
+    )
+    test_file = tmp_path / "test_spi.c"
+    test_file.write_text(existing)
+    baseline = (
+        "static bool is_valid_speed(uint32_t speed) {\n    return (speed == 8000000);\n}\n\n"
+        "static int check_config(const spi_config_t *config) {\n    return is_valid_speed(config->speed_hz);\n}\n\n"
+        "int spi_set_config(const spi_config_t *config) {\n    if (!check_config(config)) {\n        return SPI_ERROR;\n    }\n    return SPI_OK;\n}\n\n"
+        "int spi_get_state(void) {\n    return 0;\n}\n"
+    )
+    current = baseline.replace("speed == 8000000", "speed == 16000000")
+    mock_llm = mocker.patch("nodes.call_llm", return_value="```c\n```")
+    mocker.patch("nodes.build_tests")
+
+    node.exec({
+        "baseline": baseline, "target_content": current, "target_filename": "spi.c",
+        "test_path": str(test_file), "existing_tests": existing,
+        "repo_path": str(tmp_path), "source_path": "spi.c", "include_dirs": []
+    })
+
+    prompt_arg = _prompt_text(mock_llm)
+    assert "test_set_config_rejects_16mhz" in prompt_arg
+    assert "test_unrelated" not in prompt_arg
+
+
+@pytest.mark.parametrize("existing, build_error", [
+    ("void test_init(void) {\n    spi_init();\n}\n", None),
+    ("void test_init(void) {\n    spi_init();\n}\n\nint main(void) {\n    return UNITY_END();\n}\n", RuntimeError("gcc failed")),
+])
+def test_diff_update_node_keeps_existing_tests_on_failure(mocker, tmp_path, existing, build_error):
+    """Verify the test file is left untouched when the patch cannot be merged or does not build."""
+    node = DiffUpdateNode()
+    test_file = tmp_path / "test_spi.c"
+    test_file.write_text(existing)
+    mocker.patch("nodes.call_llm", return_value="```c\nvoid test_new(void) {\n    spi_init();\n}\n```")
+    mocker.patch("nodes.build_tests", side_effect=build_error)
+
+    summary = node.exec({
+        "baseline": "int spi_init(void) {\n    return 0;\n}\n", "target_content": "int spi_init(void) {\n    return 1;\n}\n",
+        "target_filename": "spi.c", "test_path": str(test_file), "existing_tests": existing,
+        "repo_path": str(tmp_path), "source_path": "spi.c", "include_dirs": []
+    })
+
+    assert summary is None
+    assert test_file.read_text() == existing
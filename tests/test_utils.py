@@ -1,9 +1,17 @@
 import pytest
 import requests
+import numpy as np
 from unittest.mock import MagicMock, mock_open, patch
 
-from utils.call_llm import call_llm
+import time
+from utils.call_llm import call_llm, _chat, _stitch
+from utils.llm_backends import Backend, BackendPool, percentile
 from utils.get_embedding import get_embedding
+from utils.c_code import is_c_code_complete
+from utils.coverage import parse_gcov, uncovered_functions, merge_test_functions
+from utils.source_diff import diff_sources, apply_test_patch
+from utils.vector_store import VectorStore
+from utils.project_index import ContentStore, load_index, save_index, scan_file
 
 # --- Tests for call_llm (Updated to patch the correct import source) ---
 @patch('openai.AzureOpenAI')
@@ -23,6 +31,28 @@ def test_call_llm_success(mock_azure_openai):
     mock_client_instance.chat.completions.create.assert_called_once()
 
 
+@patch('openai.AzureOpenAI')
+def test_call_llm_sends_messages_and_records_cached_tokens(mock_azure_openai, mocker):
+    """Test that structured messages are sent as-is and prefix-cache hits are counted."""
+    mocker.patch.dict("utils.call_llm.token_usage", {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0})
+    mock_completion = MagicMock()
+    mock_completion.choices = [MagicMock()]
+    mock_completion.choices[0].message.content = "ok"
+    mock_completion.usage.prompt_tokens = 1500
+    mock_completion.usage.completion_tokens = 20
+    mock_completion.usage.prompt_tokens_details.cached_tokens = 1280
+    mock_client_instance = MagicMock()
+    mock_client_instance.chat.completions.create.return_value = mock_completion
+    mock_azure_openai.return_value = mock_client_instance
+    messages = [{"role": "system", "content": "static"}, {"role": "user", "content": "module"}]
+
+    call_llm(messages, use_cache=False)
+
+    from utils.call_llm import token_usage
+    assert mock_client_instance.chat.completions.create.call_args.kwargs["messages"] == messages
+    assert token_usage == {"prompt_tokens": 1500, "completion_tokens": 20, "cached_tokens": 1280}
+
+
 @patch('openai.AzureOpenAI')
 def test_call_llm_api_error(mock_azure_openai):
     """Test call_llm when the API client raises an error."""
@@ -34,6 +64,132 @@ def test_call_llm_api_error(mock_azure_openai):
         call_llm("test prompt", use_cache=False)
 
 
+@patch('openai.AzureOpenAI')
+def test_call_llm_continues_truncated_response(mock_azure_openai):
+    """Test that a cut-off response is resumed and stitched instead of regenerated."""
+    first, second = MagicMock(), MagicMock()
+    first.choices = [MagicMock(finish_reason="length")]
+    first.choices[0].message.content = "```c\nvoid test_a(void) {\n    spi_"
+    second.choices = [MagicMock(finish_reason="stop")]
+    second.choices[0].message.content = "```c\ninit();\n}\n```"
+    mock_client_instance = MagicMock()
+    mock_client_instance.chat.completions.create.side_effect = [first, second]
+    mock_azure_openai.return_value = mock_client_instance
+
+    result = call_llm("test prompt", use_cache=False, complete_check=is_c_code_complete)
+
+    assert result == "```c\nvoid test_a(void) {\n    spi_init();\n}\n```"
+    assert mock_client_instance.chat.completions.create.call_count == 2
+    follow_up = mock_client_instance.chat.completions.create.call_args.kwargs["messages"]
+    assert follow_up[1] == {"role": "assistant", "content": "```c\nvoid test_a(void) {\n    spi_"}
+
+
+@pytest.mark.parametrize("partial, continuation, expected", [
+    ("foo(bar(1", "));", "foo(bar(1));"),
+    ("    }\n", "}\n", "    }\n}\n"),
+    ("TEST_ASSERT_EQUAL(1, 1", "1);", "TEST_ASSERT_EQUAL(1, 11);"),
+    ("```c\nint x;\n", "```\nint y;\n```", "```c\nint x;\nint y;\n```"),
+    ("```c\nint x;\n", "```C\nint y;\n```", "```c\nint x;\nint y;\n```"),
+    ("```c\n    TEST_ASSERT_EQUAL_INT(SPI_OK, spi_", "    TEST_ASSERT_EQUAL_INT(SPI_OK, spi_init());",
+     "```c\n    TEST_ASSERT_EQUAL_INT(SPI_OK, spi_init());"),
+])
+def test_stitch_only_drops_substantial_overlap(partial, continuation, expected):
+    """Test that short coincidental overlaps are kept and any re-opened fence is dropped."""
+    assert _stitch(partial, continuation) == expected
+
+
+def test_is_c_code_complete_detects_cut_off_code():
+    """Test the structural truncation check on extracted C."""
+    assert is_c_code_complete("```c\nint main(void) { char *s = \"}\"; return 0; }\n```")
+    assert not is_c_code_complete("```c\nint main(void) { return 0;")
+    assert not is_c_code_complete("```c\nint main(void) { return 0; }\n")
+    assert not is_c_code_complete("```c\nint main(void) { /* unfinished\n```")
+    assert not is_c_code_complete("```\nint main(void) { return 0;")
+
+
+def test_is_c_code_complete_ignores_prose_outside_the_fence():
+    """Test that an apostrophe in surrounding prose is not mistaken for an open literal."""
+    assert is_c_code_complete("Here's the file:\n```\nint main(void){return 0;}\n```")
+    assert is_c_code_complete("Here's the file:\n```C\nint main(void){return 0;}\n```\nIt's done.")
+    assert is_c_code_complete("Sure, here's what I'd change.")
+
+
+@patch('openai.AzureOpenAI')
+def test_call_llm_does_not_continue_finished_prose_reply(mock_azure_openai):
+    """Test that a stopped reply with prose around a bare fence is not resumed."""
+    response = MagicMock()
+    response.choices = [MagicMock(finish_reason="stop")]
+    response.choices[0].message.content = "Here's the file:\n```\nint main(void){return 0;}\n```"
+    mock_client_instance = MagicMock()
+    mock_client_instance.chat.completions.create.return_value = response
+    mock_azure_openai.return_value = mock_client_instance
+
+    call_llm("test prompt", use_cache=False, complete_check=is_c_code_complete)
+
+    assert mock_client_instance.chat.completions.create.call_count == 1
+
+
+def _stream(text, delay=0.0):
+    """Yields a fake streaming completion, optionally stalling before the first token."""
+    time.sleep(delay)
+    chunk = MagicMock(usage=None)
+    chunk.choices = [MagicMock(finish_reason="stop")]
+    chunk.choices[0].delta.content = text
+    yield chunk
+
+
+def test_chat_hedges_slow_primary_to_secondary(mocker, monkeypatch):
+    """Test that a primary slow to its first token is hedged and the faster answer wins."""
+    primary = Backend("primary", "https://a", "k", "dep-a", "v")
+    secondary = Backend("secondary", "https://b", "k", "dep-b", "v")
+    mocker.patch("utils.call_llm.get_pool", return_value=BackendPool([primary, secondary]))
+    monkeypatch.setenv("LLM_HEDGE_DELAY", "0.05")
+    clients = {
+        "primary": MagicMock(**{"chat.completions.create.side_effect": lambda **kw: _stream("slow", delay=1.0)}),
+        "secondary": MagicMock(**{"chat.completions.create.side_effect": lambda **kw: _stream("fast")}),
+    }
+    mocker.patch("utils.call_llm._client", side_effect=lambda backend: clients[backend.name])
+
+    text, finish_reason = _chat([{"role": "user", "content": "hi"}], 16)
+
+    assert text == "fast"
+    assert finish_reason == "stop"
+    assert secondary.wins == 1 and primary.wins == 0
+    assert clients["primary"].chat.completions.create.call_args.kwargs["stream"] is True
+    assert "stream_options" not in clients["primary"].chat.completions.create.call_args.kwargs
+
+
+def test_backend_streams_usage_only_on_supporting_api_versions():
+    """Test that stream_options is gated on the API version that introduced it."""
+    assert not Backend("a", "https://a", "k", "dep", "2024-05-01-preview").streams_usage
+    assert Backend("b", "https://b", "k", "dep", "2024-09-01-preview").streams_usage
+    assert Backend("c", "https://c", "k", "dep", "2024-10-21").streams_usage
+
+
+def test_chat_fails_over_when_primary_errors(mocker):
+    """Test that an error from the primary is retried on the next backend."""
+    primary = Backend("primary", "https://a", "k", "dep-a", "v")
+    secondary = Backend("secondary", "https://b", "k", "dep-b", "v")
+    mocker.patch("utils.call_llm.get_pool", return_value=BackendPool([primary, secondary]))
+    clients = {
+        "primary": MagicMock(**{"chat.completions.create.side_effect": Exception("timeout")}),
+        "secondary": MagicMock(**{"chat.completions.create.side_effect": lambda **kw: _stream("ok")}),
+    }
+    mocker.patch("utils.call_llm._client", side_effect=lambda backend: clients[backend.name])
+
+    assert _chat([{"role": "user", "content": "hi"}], 16)[0] == "ok"
+    assert primary.failures == 1
+    assert primary.stats()["requests"] == 0 and secondary.stats()["requests"] == 1
+
+
+def test_percentile_nearest_rank():
+    """Test the latency percentile helper."""
+    samples = list(range(1, 101))
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 99) == 99
+    assert percentile([], 90) is None
+
+
 def test_call_llm_uses_cache(mocker):
     """Test that call_llm uses the cache and avoids an API call."""
     prompt = "cached question"
@@ -73,4 +229,179 @@ def test_get_embedding_api_error(mocker):
     mocker.patch("requests.post", return_value=mock_response)
 
     with pytest.raises(requests.exceptions.HTTPError, match='Ollama API Error: Internal server error'):
-        get_embedding("test text")
\ No newline at end of file
+        get_embedding("test text")
+
+
+# --- Tests for project_index ---
+def test_scan_file_reuses_unchanged_record(tmp_path):
+    """Test that a persisted record is reused when size and mtime match."""
+    source = tmp_path / "spi.c"
+    source.write_text('#include "spi.h"\nint x;\n')
+    index_path = str(tmp_path / "index.json")
+
+    record = scan_file(str(source))
+    save_index(index_path, [record])
+    previous = load_index(index_path)[str(source)]
+    previous.digest = "stale"
+
+    assert record.includes == ("spi.h",)
+    assert scan_file(str(source), previous).digest == "stale"
+
+
+def test_content_store_evicts_least_recently_used(tmp_path):
+    """Test that the content store stays under its byte cap."""
+    paths = []
+    for name in ("a.c", "b.c", "c.c"):
+        path = tmp_path / name
+        path.write_text("x" * 10)
+        paths.append(str(path))
+    store = ContentStore(max_bytes=25)
+
+    for path in paths:
+        assert store.get(path) == "x" * 10
+
+    assert store.current_bytes == 20
+    assert paths[0] not in store._cache
+    store.get(paths[2])
+    assert store.hits == 1
+
+
+# --- Tests for coverage ---
+GCOV_SAMPLE = """        -:    0:Source:spi.c
+function spi_init called 1 returned 100% blocks executed 75%
+        1:   18:int spi_init(void) {
+        1:   19:    if (g_spi_state != SPI_STATE_UNINITIALIZED) {
+branch  0 taken 0% (fallthrough)
+branch  1 taken 100%
+    #####:   20:        return SPI_ERROR_ALREADY_INITIALIZED;
+        -:   21:    }
+        1:   22:    return SPI_SUCCESS;
+"""
+
+
+def test_parse_gcov_reports_uncovered_lines_and_branches():
+    """Test that gcov output is mapped to per-function gaps."""
+    report = parse_gcov(GCOV_SAMPLE)
+
+    assert report["lines_total"] == 4
+    assert report["lines_covered"] == 3
+    assert report["branches_taken"] == 1
+    gaps = uncovered_functions(report)
+    assert gaps["spi_init"]["uncovered_lines"] == [20]
+    assert gaps["spi_init"]["uncovered_branches"] == [19]
+
+
+def test_merge_test_functions_registers_new_tests_only():
+    """Test that only unseen test functions are merged and registered in main."""
+    existing = (
+        "void test_a(void) {\n}\n\n"
+        "int main(void) {\n    UNITY_BEGIN();\n    RUN_TEST(test_a);\n    return UNITY_END();\n}\n"
+    )
+    additions = "```c\nvoid test_a(void) {\n}\nvoid test_b(void) {\n    if (1) { }\n}\n```"
+
+    merged, added = merge_test_functions(existing, additions)
+
+    assert added == ["test_b"]
+    assert merged.count("void test_a(void)") == 1
+    assert "    RUN_TEST(test_a);\n    RUN_TEST(test_b);\n    return UNITY_END();" in merged
+
+
+@pytest.mark.parametrize("main_source, expected", [
+    ("int main(void) {\n    UNITY_BEGIN();\n    UNITY_END();\n    return 0;\n}\n",
+     "    RUN_TEST(test_b);\n    UNITY_END();\n    return 0;"),
+    ("int main(void) {\n    UNITY_BEGIN();\n    return (UNITY_END());\n}\n",
+     "    RUN_TEST(test_b);\n    return (UNITY_END());"),
+    ("int main(void) {\n    UNITY_BEGIN();\n    return 0;\n}\n",
+     "    RUN_TEST(test_b);\n    return 0;\n}"),
+    ("int main(void){ UNITY_BEGIN(); RUN_TEST(test_init); return UNITY_END(); }\n",
+     "int main(void){ UNITY_BEGIN(); RUN_TEST(test_init); RUN_TEST(test_b); return UNITY_END(); }"),
+    ("int main(void) {\n    UNITY_BEGIN();\n    if (1) {\n        RUN_TEST(test_a);\n    }\n    return UNITY_END();\n}\n",
+     "    }\n    RUN_TEST(test_b);\n    return UNITY_END();"),
+    ("int main(void){ UNITY_BEGIN(); return 0; }\n",
+     "int main(void){ UNITY_BEGIN(); RUN_TEST(test_b); return 0; }"),
+])
+def test_merge_test_functions_handles_other_main_endings(main_source, expected):
+    """Test that RUN_TEST calls land inside main, before the statement calling UNITY_END()."""
+    merged, added = merge_test_functions(main_source, "void test_b(void) {\n}\n")
+
+    assert added == ["test_b"]
+    assert expected in merged
+
+
+# --- Tests for source_diff ---
+OLD_SOURCE = """int spi_init(void) {
+    return 0;
+}
+
+int spi_deinit(void) {
+    return 0;
+}
+"""
+
+
+def test_diff_sources_reports_touched_functions():
+    """Test that only functions touched by the diff are reported."""
+    new_source = OLD_SOURCE.replace("int spi_deinit(void) {\n    return 0;", "int spi_deinit(void) {\n    return -1;")
+    new_source += "\nint spi_reset(void) {\n    return 0;\n}\n"
+
+    changes = diff_sources(OLD_SOURCE, new_source, "spi.c")
+
+    assert changes["changed"] == ["spi_deinit"]
+    assert changes["added"] == ["spi_reset"]
+    assert changes["removed"] == []
+    assert "+    return -1;" in changes["diff"]
+
+
+def test_apply_test_patch_replaces_adds_and_removes():
+    """Test that a function-level patch is applied to an existing test file."""
+    existing = (
+        "void test_a(void) {\n    old();\n}\n\nvoid test_b(void) {\n}\n\n"
+        "int main(void) {\n    UNITY_BEGIN();\n    RUN_TEST(test_a);\n    RUN_TEST(test_b);\n    return UNITY_END();\n}\n"
+    )
+    patch = "```c\nvoid test_a(void) {\n    updated();\n}\n// REMOVE: test_b\nvoid test_c(void) {\n}\n```"
+
+    patched, summary = apply_test_patch(existing, patch)
+
+    assert summary == {"replaced": ["test_a"], "added": ["test_c"], "removed": ["test_b"]}
+    assert "updated();" in patched and "old();" not in patched
+    assert "test_b" not in patched
+    assert "RUN_TEST(test_c);" in patched
+
+
+# --- Tests for vector_store ---
+def test_vector_store_sync_reuses_persisted_rows(tmp_path):
+    """Test that only new or changed keys are embedded and the store reloads memory-mapped."""
+    embed = MagicMock(side_effect=lambda key: {"a.md": [1.0, 0.0], "b.md": [0.0, 2.0], "c.md": [1.0, 1.0]}[key])
+    store = VectorStore(str(tmp_path))
+
+    assert store.sync([("a.md", "d1"), ("b.md", "d2")], embed, model="m") == 2
+    reloaded = VectorStore(str(tmp_path))
+    assert reloaded.sync([("a.md", "d1"), ("c.md", "d3")], embed, model="m") == 1
+    assert reloaded.sync([("a.md", "d1-edited"), ("c.md", "d3")], embed, model="m") == 1
+
+    assert embed.call_count == 4
+    assert reloaded.meta["keys"] == ["a.md", "c.md"]
+    assert isinstance(VectorStore(str(tmp_path)).vectors, np.memmap)
+
+
+def test_vector_store_keeps_identical_specs_as_separate_rows(tmp_path):
+    """Test that two paths with the same content digest are both kept."""
+    store = VectorStore(str(tmp_path))
+
+    store.sync([("a.md", "same"), ("b.md", "same")], lambda key: [1.0, 0.0], model="m")
+
+    assert len(store) == 2
+    assert sorted(key for _, key in store.search([1.0, 0.0], k=2)) == ["a.md", "b.md"]
+
+
+def test_vector_store_int8_search_ranks_by_cosine(tmp_path):
+    """Test vectorized top-k search over int8-quantized vectors."""
+    vectors = {"x.md": [1.0, 0.0, 0.0], "y.md": [0.6, 0.8, 0.0], "z.md": [0.0, 0.0, 1.0]}
+    store = VectorStore(str(tmp_path), dtype="int8")
+    store.sync([(k, f"digest-{k}") for k in vectors], lambda key: vectors[key], model="m")
+
+    results = store.search([2.0, 0.1, 0.0], k=2)
+
+    assert [key for _, key in results] == ["x.md", "y.md"]
+    assert results[0][0] == pytest.approx(0.9988, abs=0.01)
+    assert store.vectors.dtype == np.int8
@@ -0,0 +1,68 @@
+import re
+
+FENCE = re.compile(r"```([\w+-]*)[ \t]*\n?")
+
+
+def _code_block(response: str):
+    """
+    Returns (code, closed) for the ```c block, or else the first fenced block
+    of any language, or None when the response has no fence at all.
+    """
+    fences = list(FENCE.finditer(response))
+    if not fences:
+        return None
+    opening = next((m for m in fences if m.group(1).lower() == "c"), fences[0])
+    rest = response[opening.end():]
+    end = rest.find("```")
+    return (rest, False) if end == -1 else (rest[:end], True)
+
+
+def extract_c_code(response: str) -> str:
+    """Returns the contents of the first ```c (or else any fenced) block, or the whole response if there is none."""
+    block = _code_block(response)
+    return response if block is None else block[0]
+
+
+def is_c_code_complete(response: str) -> bool:
+    """
+    Structural check for truncated C: the fenced block must be closed and braces,
+    parentheses, comments and literals inside it must all be balanced. A reply
+    without a fence is not checked, since prose (e.g. an apostrophe) would read as
+    an open literal; real cut-offs there are caught by finish_reason instead.
+    """
+    block = _code_block(response)
+    if block is None:
+        return True
+    code, closed = block
+    if not closed:
+        return False
+
+    depth = {"{": 0, "(": 0}
+    closing = {"}": "{", ")": "("}
+    i, n = 0, len(code)
+    while i < n:
+        ch = code[i]
+        if code.startswith("//", i):
+            newline = code.find("\n", i)
+            i = n if newline == -1 else newline
+        elif code.startswith("/*", i):
+            end = code.find("*/", i + 2)
+            if end == -1:
+                return False
+            i = end + 1
+        elif ch in "\"'":
+            i += 1
+            while i < n and code[i] != ch:
+                if code[i] == "\n":
+                    return False
+                i += 2 if code[i] == "\\" else 1
+            if i >= n:
+                return False
+        elif ch in depth:
+            depth[ch] += 1
+        elif ch in closing:
+            depth[closing[ch]] -= 1
+            if depth[closing[ch]] < 0:
+                return False
+        i += 1
+    return all(d == 0 for d in depth.values())
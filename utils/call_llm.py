@@ -1,9 +1,15 @@
 import os
+import re
 import logging
 import json
+import time
+import queue
+import threading
 from datetime import datetime
 from dotenv import load_dotenv
 
+from utils.llm_backends import get_pool
+
 # Load environment variables
 load_dotenv()
 
@@ -23,44 +29,229 @@ if not logger.handlers:
 # Cache file path
 cache_file = "llm_cache.json"
 
-def call_llm(prompt: str, use_cache: bool = True, max_tokens: int = 4096) -> str:
-    logger.info(f"PROMPT: {prompt}")
-    cache = {}
+# Clients are reused across calls so a long-running process keeps its connection pool warm
+_clients = {}
 
-    if use_cache and os.path.exists(cache_file):
-        try:
-            with open(cache_file, "r", encoding="utf-8") as f:
-                cache = json.load(f)
-        except Exception:
-            logger.warning("Failed to load cache, starting with empty cache")
-        if prompt in cache:
-            logger.info(f"RESPONSE (from cache): {cache[prompt]}")
-            return cache[prompt]
+# Running totals of tokens billed by the API (local cache hits cost nothing).
+# cached_tokens is the part of prompt_tokens served from the provider's prefix cache.
+token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+_usage_lock = threading.Lock()
 
-    try:
-        from openai import AzureOpenAI
 
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview")
+def _record_usage(usage):
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    with _usage_lock:
+        for key, value in (("prompt_tokens", prompt_tokens), ("completion_tokens", completion_tokens), ("cached_tokens", cached_tokens)):
+            if isinstance(value, int):
+                token_usage[key] += value
+    if isinstance(prompt_tokens, int):
+        logger.info(f"USAGE: prompt={prompt_tokens} cached={cached_tokens if isinstance(cached_tokens, int) else 0} completion={completion_tokens}")
+
+
+# How many times a truncated response is resumed before giving up
+MAX_CONTINUATIONS = int(os.getenv("LLM_MAX_CONTINUATIONS", "2"))
+
+CONTINUE_PROMPT = (
+    "Your previous response was cut off. Continue exactly where it stopped. "
+    "Do not repeat anything already written, do not add a preamble, and do not restart the code block."
+)
+
 
-        client = AzureOpenAI(
-            api_key=api_key,
-            api_version=api_version,
-            azure_endpoint=endpoint
+def _client(backend):
+    from openai import AzureOpenAI
+
+    client_key = (AzureOpenAI, backend.endpoint, backend.api_key, backend.api_version)
+    if client_key not in _clients:
+        _clients[client_key] = AzureOpenAI(
+            api_key=backend.api_key,
+            api_version=backend.api_version,
+            azure_endpoint=backend.endpoint
         )
+    return _clients[client_key]
+
 
-        response = client.chat.completions.create(
-            model=deployment,
-            messages=[{"role": "user", "content": prompt}],
+def _single_chat(backend, messages: list, max_tokens: int) -> tuple:
+    start = time.monotonic()
+    try:
+        response = _client(backend).chat.completions.create(
+            model=backend.deployment,
+            messages=messages,
             max_tokens=max_tokens,
             # --- START OF FIX: Add a reasonable timeout to prevent hanging ---
             timeout=30.0 
             # --- END OF FIX ---
         )
+    except Exception:
+        backend.record_failure()
+        raise
+    backend.record_success(time.monotonic() - start)
+    _record_usage(getattr(response, "usage", None))
+    choice = response.choices[0]
+    return choice.message.content or "", getattr(choice, "finish_reason", None)
+
+
+def _stream_attempt(backend, messages, max_tokens, cancel, responded, results):
+    """Streams one request, signalling `responded` on the first token (or on failure)."""
+    start = time.monotonic()
+    try:
+        # Older API versions reject stream_options, so their streamed usage goes unrecorded.
+        usage_options = {"stream_options": {"include_usage": True}} if backend.streams_usage else {}
+        stream = _client(backend).chat.completions.create(
+            model=backend.deployment,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            timeout=30.0,
+            **usage_options
+        )
+        parts, finish_reason = [], None
+        try:
+            for chunk in stream:
+                if cancel.is_set():
+                    return
+                if getattr(chunk, "usage", None):
+                    _record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta and choice.delta.content:
+                    if not responded.is_set():
+                        backend.record_first_token(time.monotonic() - start)
+                        responded.set()
+                    parts.append(choice.delta.content)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        backend.record_success(time.monotonic() - start)
+        results.put((backend, ("".join(parts), finish_reason), None))
+    except Exception as e:
+        if cancel.is_set():
+            return
+        backend.record_failure()
+        logger.warning(f"LLM backend {backend.name} failed: {e}")
+        results.put((backend, None, e))
+    finally:
+        responded.set()
+
+
+def _hedged_chat(backends: list, messages: list, max_tokens: int) -> tuple:
+    """
+    Streams from the preferred backend. If it has not produced a first token
+    within its p90 first-token latency, the same request is sent to the next
+    backend; the first complete answer wins and the other stream is cancelled.
+    A failed attempt fails over to the next backend.
+    """
+    results = queue.Queue()
+    attempts = []
+    remaining = iter(backends)
+
+    def launch():
+        backend = next(remaining, None)
+        if backend is None:
+            return False
+        cancel, responded = threading.Event(), threading.Event()
+        threading.Thread(
+            target=_stream_attempt, args=(backend, messages, max_tokens, cancel, responded, results), daemon=True
+        ).start()
+        attempts.append((backend, cancel, responded))
+        return True
+
+    launch()
+    primary, _, primary_responded = attempts[0]
+    if not primary_responded.wait(primary.hedge_delay()):
+        if launch():
+            logger.info(f"Hedging: {primary.name} slow to first token, also sending to {attempts[-1][0].name}")
+
+    pending, last_error = len(attempts), None
+    while pending:
+        backend, outcome, error = results.get()
+        pending -= 1
+        if error is None:
+            for other, cancel, _ in attempts:
+                if other is not backend:
+                    cancel.set()
+            backend.wins += 1
+            return outcome
+        last_error = error
+        if launch():
+            pending += 1
+    raise last_error
+
+
+def _chat(messages: list, max_tokens: int) -> tuple:
+    backends = get_pool().ordered()
+    if len(backends) == 1:
+        return _single_chat(backends[0], messages, max_tokens)
+    return _hedged_chat(backends, messages, max_tokens)
+
+
+def latency_report() -> dict:
+    """Per-backend request counts, hedge wins and p50/p95/p99 first-token and total latencies."""
+    return get_pool().report()
+
+
+# Shorter overlaps are as likely to be coincidence (a repeated `}` or digit) as a real repeat
+MIN_STITCH_OVERLAP = 20
+REOPENED_FENCE = re.compile(r"^\s*```[\w+-]*[ \t]*(\n|$)")
+
+
+def _stitch(partial: str, continuation: str) -> str:
+    """Joins a continuation onto a cut-off response, dropping a re-opened code fence or repeated overlap."""
+    if "```" in partial:
+        continuation = REOPENED_FENCE.sub("", continuation, count=1)
+    for size in range(min(len(partial), len(continuation), 200), MIN_STITCH_OVERLAP - 1, -1):
+        if partial.endswith(continuation[:size]):
+            return partial + continuation[size:]
+    return partial + continuation
+
+
+def call_llm(prompt, use_cache: bool = True, max_tokens: int = 4096,
+             max_continuations: int = None, complete_check=None) -> str:
+    """
+    Sends a prompt to the LLM. `prompt` is either a string (sent as one user
+    message) or a list of chat messages. If the response is cut off
+    (finish_reason "length", or `complete_check(text)` returns False) it is
+    resumed with continuation requests and the pieces are stitched together.
+    """
+    messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+    cache_key = prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False)
+    logger.info(f"PROMPT: {cache_key}")
+    cache = {}
+    if max_continuations is None:
+        max_continuations = MAX_CONTINUATIONS
+
+    if use_cache and os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except Exception:
+            logger.warning("Failed to load cache, starting with empty cache")
+        if cache_key in cache:
+            logger.info(f"RESPONSE (from cache): {cache[cache_key]}")
+            return cache[cache_key]
+
+    try:
+        response_text, finish_reason = _chat(messages, max_tokens)
+
+        continuations = 0
+        while continuations < max_continuations and (
+            finish_reason == "length" or (complete_check is not None and not complete_check(response_text))
+        ):
+            continuations += 1
+            logger.info(f"Response truncated (finish_reason={finish_reason}), continuation {continuations}")
+            follow_up = messages + [
+                {"role": "assistant", "content": response_text},
+                {"role": "user", "content": CONTINUE_PROMPT},
+            ]
+            more, finish_reason = _chat(follow_up, max_tokens)
+            response_text = _stitch(response_text, more)
 
-        response_text = response.choices[0].message.content.strip()
+        response_text = response_text.strip()
 
     except Exception as e:
         logger.error(f"LLM error: {e}")
@@ -68,7 +259,7 @@ def call_llm(prompt: str, use_cache: bool = True, max_tokens: int = 4096) -> str
 
     logger.info(f"RESPONSE: {response_text}")
     if use_cache:
-        cache[prompt] = response_text
+        cache[cache_key] = response_text
         try:
             with open(cache_file, "w", encoding="utf-8") as f:
                 json.dump(cache, f, indent=2, ensure_ascii=False)
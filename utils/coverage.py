@@ -0,0 +1,203 @@
+import os
+import re
+import shutil
+import subprocess
+import logging
+
+from utils.c_code import extract_c_code
+
+logger = logging.getLogger("llm_logger")
+
+CFLAGS = ["-std=c99", "-Wall", "-Wextra", "-pedantic", "-DTEST", "--coverage"]
+FUNCTION_MARKER = re.compile(r"^function (\S+) called")
+TEST_FUNCTION = re.compile(r"^\s*void\s+(test_\w+)\s*\(\s*void\s*\)\s*\{", re.MULTILINE)
+UNITY_FAILURE = re.compile(r"^[^\n:]*:\d+:(test_\w+):FAIL", re.MULTILINE)
+
+
+def _run(cmd, cwd):
+    result = subprocess.run(cmd, cwd=cwd, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(f"Command failed ({' '.join(cmd)}): {result.stderr.strip() or result.stdout.strip()}")
+    return result.stdout
+
+
+def build_tests(repo_path: str, source_path: str, test_path: str, include_dirs: list, build_dir: str = None) -> str:
+    """
+    Compiles the module, its Unity tests and Unity itself with --coverage into
+    `build_dir` and returns the path of the linked test runner.
+    """
+    repo_path = os.path.abspath(repo_path)
+    unity_src = os.path.join(repo_path, "unity", "src", "unity.c")
+    if not os.path.exists(unity_src):
+        raise FileNotFoundError(f"Unity not found at {unity_src}")
+    if shutil.which("gcc") is None or shutil.which("gcov") is None:
+        raise FileNotFoundError("gcc and gcov are required for coverage measurement.")
+
+    build_dir = os.path.abspath(build_dir or os.path.join(repo_path, ".coverage_build"))
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    inc_flags = [f"-I{os.path.abspath(d)}" for d in [repo_path, os.path.dirname(unity_src)] + list(include_dirs)]
+    objects = []
+    for src in (source_path, test_path, unity_src):
+        obj = os.path.join(build_dir, os.path.splitext(os.path.basename(src))[0] + ".o")
+        _run(["gcc", *CFLAGS, *inc_flags, "-c", os.path.abspath(src), "-o", obj], cwd=build_dir)
+        objects.append(obj)
+
+    runner = os.path.join(build_dir, "test_runner")
+    _run(["gcc", "--coverage", *objects, "-o", runner], cwd=build_dir)
+    return runner
+
+
+def measure_coverage(repo_path: str, source_path: str, test_path: str, include_dirs: list, build_dir: str = None) -> dict:
+    """
+    Compiles the module and its Unity tests with --coverage, runs the suite and
+    returns the parsed gcov report for the module under test, along with the
+    runner's exit status and the names of the tests Unity reported as failing.
+    """
+    runner = build_tests(repo_path, source_path, test_path, include_dirs, build_dir)
+    build_dir = os.path.dirname(runner)
+    # A failing Unity test still produces coverage data, so the run is not aborted on failure.
+    result = subprocess.run([runner], cwd=build_dir, capture_output=True, text=True, timeout=120)
+    _run(["gcov", "-b", "-o", build_dir, os.path.abspath(source_path)], cwd=build_dir)
+
+    gcov_path = os.path.join(build_dir, os.path.basename(source_path) + ".gcov")
+    with open(gcov_path, 'r', encoding='utf-8') as f:
+        report = parse_gcov(f.read())
+    report["tests_passed"] = result.returncode == 0
+    report["failed_tests"] = UNITY_FAILURE.findall(result.stdout)
+    return report
+
+
+def parse_gcov(gcov_text: str) -> dict:
+    """
+    Parses `gcov -b` output into line/branch totals and, per function, the
+    source excerpt plus the line numbers and branches that were never taken.
+    """
+    report = {"lines_total": 0, "lines_covered": 0, "branches_total": 0, "branches_taken": 0, "functions": {}}
+    current = None
+    last_line = None
+
+    for raw in gcov_text.splitlines():
+        marker = FUNCTION_MARKER.match(raw)
+        if marker:
+            current = report["functions"].setdefault(
+                marker.group(1), {"excerpt": [], "uncovered_lines": [], "uncovered_branches": []}
+            )
+            continue
+        if raw.startswith("branch"):
+            report["branches_total"] += 1
+            if "never executed" in raw or "taken 0%" in raw:
+                if current is not None and last_line is not None:
+                    current["uncovered_branches"].append(last_line)
+            else:
+                report["branches_taken"] += 1
+            continue
+
+        parts = raw.split(":", 2)
+        if len(parts) < 3:
+            continue
+        count, lineno = parts[0].strip(), parts[1].strip()
+        if not lineno.isdigit() or lineno == "0":
+            continue
+        last_line = int(lineno)
+        if current is not None:
+            current["excerpt"].append(f"{count:>6}: {last_line:4}: {parts[2]}")
+
+        if count == "-":
+            continue
+        report["lines_total"] += 1
+        if count.startswith("#####") or count.startswith("====="):
+            if current is not None:
+                current["uncovered_lines"].append(last_line)
+        else:
+            report["lines_covered"] += 1
+
+    report["line_percent"] = _percent(report["lines_covered"], report["lines_total"])
+    report["branch_percent"] = _percent(report["branches_taken"], report["branches_total"])
+    return report
+
+
+def _percent(part, total):
+    return round(100.0 * part / total, 2) if total else 100.0
+
+
+def uncovered_functions(report: dict) -> dict:
+    """Returns only the functions that still have uncovered lines or branches."""
+    return {
+        name: info for name, info in report["functions"].items()
+        if info["uncovered_lines"] or info["uncovered_branches"]
+    }
+
+
+def extract_test_functions(code: str) -> dict:
+    """Extracts `void test_x(void) { ... }` definitions from C code, keyed by name."""
+    functions = {}
+    for match in TEST_FUNCTION.finditer(code):
+        depth = 0
+        for end in range(match.end() - 1, len(code)):
+            if code[end] == "{":
+                depth += 1
+            elif code[end] == "}":
+                depth -= 1
+                if depth == 0:
+                    functions[match.group(1)] = code[match.start():end + 1].strip()
+                    break
+    return functions
+
+
+def merge_test_functions(existing: str, additions: str) -> tuple:
+    """
+    Inserts new test functions before `main` and registers them with RUN_TEST.
+    Returns the merged file and the names of the tests that were added.
+    """
+    additions = extract_c_code(additions)
+
+    known = extract_test_functions(existing)
+    new_tests = {name: body for name, body in extract_test_functions(additions).items() if name not in known}
+    if not new_tests:
+        return existing, []
+
+    main_match = re.search(r"^\s*int\s+main\s*\(", existing, re.MULTILINE)
+    if main_match is None:
+        raise ValueError("Existing test file has no main() to register new tests with.")
+
+    head, main_body = existing[:main_match.start()], existing[main_match.start():]
+    functions = "\n\n".join(new_tests.values())
+    run_calls = "".join(f"    RUN_TEST({name});\n" for name in new_tests)
+
+    # Register before the statement that calls UNITY_END(), or failing that before main's last
+    # return (or its closing brace), so the new tests run between UNITY_BEGIN() and the end.
+    end_match = re.search(r"\bUNITY_END\s*\(", main_body)
+    if end_match is not None:
+        target = end_match.start()
+    else:
+        target = _closing_brace(main_body)
+        if target is None:
+            raise ValueError("Existing test file has an unterminated main().")
+        returns = [m.start() for m in re.finditer(r"\breturn\b", main_body[:target])]
+        target = returns[-1] if returns else target
+    statement = max(main_body.rfind(delimiter, 0, target) for delimiter in ";{}") + 1
+    statement += len(main_body[statement:]) - len(main_body[statement:].lstrip())
+    line_start = main_body.rfind("\n", 0, statement) + 1
+    if main_body[line_start:statement].strip():
+        # The statement shares its line with earlier code (e.g. a one-line main), so insert inline.
+        inline_calls = "".join(f"RUN_TEST({name}); " for name in new_tests)
+        main_body = main_body[:statement] + inline_calls + main_body[statement:]
+    else:
+        main_body = main_body[:line_start] + run_calls + main_body[line_start:]
+
+    return f"{head.rstrip()}\n\n{functions}\n\n{main_body.lstrip()}", list(new_tests)
+
+
+def _closing_brace(code: str):
+    """Index of the brace that closes the first block in `code`, or None."""
+    depth = 0
+    for i, char in enumerate(code):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import math
+import time
+import threading
+from collections import deque
+
+# Below this many samples a backend's own p90 is not trusted and LLM_HEDGE_DELAY is used.
+MIN_SAMPLES = 5
+FAILURES_BEFORE_COOLDOWN = 3
+COOLDOWN_SECONDS = 60.0
+# First Azure OpenAI API version that accepts stream_options={"include_usage": True}.
+STREAM_USAGE_API_VERSION = "2024-09-01"
+
+
+def percentile(samples, pct: float):
+    """Nearest-rank percentile of a sequence of numbers, or None if it is empty."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Backend:
+    """One Azure OpenAI deployment with its recent latencies and health."""
+    __slots__ = ("name", "endpoint", "api_key", "deployment", "api_version",
+                 "first_token", "total", "failures", "wins", "unhealthy_until", "_lock")
+
+    def __init__(self, name, endpoint, api_key, deployment, api_version, window: int = 200):
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.api_version = api_version
+        self.first_token = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+        self.failures = 0
+        self.wins = 0
+        self.unhealthy_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    @property
+    def streams_usage(self) -> bool:
+        """Whether this backend's API version reports token usage on streamed responses."""
+        match = re.match(r"\d{4}-\d{2}-\d{2}", self.api_version or "")
+        return match is not None and match.group(0) >= STREAM_USAGE_API_VERSION
+
+    def record_first_token(self, seconds: float):
+        with self._lock:
+            self.first_token.append(seconds)
+
+    def record_success(self, seconds: float):
+        with self._lock:
+            self.total.append(seconds)
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= FAILURES_BEFORE_COOLDOWN:
+                self.unhealthy_until = time.monotonic() + COOLDOWN_SECONDS
+
+    def median_first_token(self):
+        with self._lock:
+            return percentile(list(self.first_token), 50)
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for a first token before duplicating the request: this backend's p90."""
+        with self._lock:
+            samples = list(self.first_token)
+        if len(samples) < MIN_SAMPLES:
+            return float(os.getenv("LLM_HEDGE_DELAY", "10.0"))
+        return percentile(samples, 90)
+
+    def stats(self) -> dict:
+        with self._lock:
+            first_token, total = list(self.first_token), list(self.total)
+        return {
+            "requests": len(total),
+            "wins": self.wins,
+            "healthy": self.healthy,
+            "first_token": {f"p{p}": percentile(first_token, p) for p in (50, 95, 99)},
+            "total": {f"p{p}": percentile(total, p) for p in (50, 95, 99)},
+        }
+
+
+def load_backends() -> list:
+    """
+    Reads backends from AZURE_OPENAI_BACKENDS, either a JSON list of
+    {"name", "endpoint", "api_key", "deployment", "api_version"} objects or a
+    comma-separated list of deployment names. Missing fields fall back to the
+    single-backend AZURE_OPENAI_* variables.
+    """
+    defaults = {
+        "endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+        "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+        "deployment": os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+        "api_version": os.getenv("AZURE_OPENAI_API_VERSION", "2024-05-01-preview"),
+    }
+    raw = os.getenv("AZURE_OPENAI_BACKENDS", "").strip()
+    if not raw:
+        entries = [{}]
+    elif raw.startswith("["):
+        entries = json.loads(raw)
+    else:
+        entries = [{"deployment": name.strip()} for name in raw.split(",") if name.strip()]
+
+    backends = []
+    for i, entry in enumerate(entries):
+        config = {**defaults, **entry}
+        name = entry.get("name") or config["deployment"] or f"backend-{i}"
+        backends.append(Backend(name, config["endpoint"], config["api_key"], config["deployment"], config["api_version"]))
+    return backends
+
+
+class BackendPool:
+    def __init__(self, backends: list):
+        if not backends:
+            raise ValueError("At least one LLM backend must be configured.")
+        self.backends = backends
+
+    def ordered(self) -> list:
+        """Healthy backends first, fastest median first-token latency first; unhealthy ones last as a fallback."""
+        def key(backend):
+            p50 = backend.median_first_token()
+            return (not backend.healthy, p50 if p50 is not None else float("inf"))
+        return sorted(self.backends, key=key)
+
+    def report(self) -> dict:
+        return {backend.name: backend.stats() for backend in self.backends}
+
+
+_pool = None
+
+
+def get_pool() -> BackendPool:
+    global _pool
+    if _pool is None:
+        _pool = BackendPool(load_backends())
+    return _pool
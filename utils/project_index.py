@@ -0,0 +1,169 @@
+import os
+import re
+import glob
+import threading
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger("llm_logger")
+
+INCLUDE_PATTERN = re.compile(rb'#\s*include\s+"([^"]+)"')
+
+
+class FileRecord:
+    """
+    Compact description of a project file. Only metadata is kept in memory;
+    the file's text is fetched on demand through a ContentStore.
+    """
+    __slots__ = ("path", "size", "mtime", "digest", "includes", "dependencies")
+
+    def __init__(self, path, size, mtime, digest, includes=(), dependencies=()):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+        self.includes = tuple(includes)
+        self.dependencies = list(dependencies)
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "size": self.size,
+            "mtime": self.mtime,
+            "digest": self.digest,
+            "includes": list(self.includes),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FileRecord":
+        return cls(data["path"], data["size"], data["mtime"], data["digest"], data.get("includes", ()))
+
+    def __repr__(self):
+        return f"FileRecord(path={self.path!r}, size={self.size}, digest={self.digest[:8]!r})"
+
+
+def scan_file(path: str, previous: FileRecord = None) -> FileRecord:
+    """
+    Builds a FileRecord by streaming the file line by line, so the full text
+    is never held in memory. If `previous` has the same size and mtime it is
+    reused without re-reading the file.
+    """
+    stat = os.stat(path)
+    if previous is not None and previous.size == stat.st_size and previous.mtime == stat.st_mtime:
+        return FileRecord(path, previous.size, previous.mtime, previous.digest, previous.includes)
+
+    digest = hashlib.sha1()
+    includes = []
+    with open(path, 'rb') as f:
+        for line in f:
+            digest.update(line)
+            match = INCLUDE_PATTERN.search(line)
+            if match:
+                includes.append(match.group(1).decode('utf-8', errors='replace'))
+    return FileRecord(path, stat.st_size, stat.st_mtime, digest.hexdigest(), includes)
+
+
+def scan_project(repo_path: str, spec_dir: str = "specs", previous: dict = None) -> dict:
+    """
+    Scans a repo for source/header files and `spec_dir` for spec files, returning
+    {"sources", "headers", "specs"} dicts of FileRecords keyed by basename.
+    Records in `previous` ({path: FileRecord}) are reused for unchanged files.
+    """
+    previous = previous or {}
+    excluded_dirs = ['/unity/', '/tests/']
+    source_files = []
+    for f in glob.glob(os.path.join(repo_path, '**/*.c'), recursive=True):
+        normalized_path = f.replace('\\', '/')
+        if os.path.basename(normalized_path).startswith('test_'):
+            continue
+        if any(excluded in normalized_path for excluded in excluded_dirs):
+            continue
+        source_files.append(f)
+
+    h_files = glob.glob(os.path.join(repo_path, '**/*.h'), recursive=True)
+    spec_files = []
+    if os.path.isdir(spec_dir):
+        spec_files = glob.glob(os.path.join(spec_dir, '**/*.md'), recursive=True)
+        spec_files += glob.glob(os.path.join(spec_dir, '**/*.txt'), recursive=True)
+
+    project_structure = {"sources": {}, "headers": {}, "specs": {}}
+    for spec_path in spec_files:
+        project_structure["specs"][os.path.basename(spec_path)] = scan_file(spec_path, previous.get(spec_path))
+    for h_path in h_files:
+        project_structure["headers"][os.path.basename(h_path)] = scan_file(h_path, previous.get(h_path))
+    for c_path in source_files:
+        record = scan_file(c_path, previous.get(c_path))
+        record.dependencies = [h for h in project_structure["headers"] if h in record.includes]
+        project_structure["sources"][os.path.basename(c_path)] = record
+    return project_structure
+
+
+def load_index(index_path: str) -> dict:
+    """Loads a persisted {path: FileRecord} index. Returns an empty dict if none exists."""
+    if not index_path or not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {entry["path"]: FileRecord.from_dict(entry) for entry in data.get("files", [])}
+    except Exception as e:
+        logger.warning(f"Failed to load project index, rescanning: {e}")
+        return {}
+
+
+def save_index(index_path: str, records) -> None:
+    """Persists FileRecords so the next scan can skip unchanged files."""
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump({"files": [r.to_dict() for r in records]}, f)
+
+
+class ContentStore:
+    """
+    LRU cache of file contents bounded by the total number of bytes held.
+    Files larger than the cap are read on every access and never cached.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        if max_bytes is None:
+            max_bytes = int(os.getenv("CONTENT_CACHE_MB", "64")) * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> str:
+        with self._lock:
+            return self._get(path)
+
+    def _get(self, path):
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            self.hits += 1
+            return self._cache[path][0]
+
+        self.misses += 1
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+        size = len(content.encode('utf-8'))
+        if size <= self.max_bytes:
+            self._cache[path] = (content, size)
+            self.current_bytes += size
+            self._evict()
+        return content
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            entry = self._cache.pop(path, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._cache:
+            _, (_, size) = self._cache.popitem(last=False)
+            self.current_bytes -= size
@@ -0,0 +1,139 @@
+import os
+import re
+import difflib
+
+from utils.c_code import extract_c_code
+from utils.coverage import extract_test_functions, merge_test_functions
+
+C_FUNCTION = re.compile(r"^[A-Za-z_][\w \t\*]*?\b(\w+)\s*\([^;{}]*\)\s*\{", re.MULTILINE)
+REMOVE_MARKER = re.compile(r"^\s*//\s*REMOVE:\s*(test_\w+)", re.MULTILINE)
+
+
+def baseline_path(repo_path: str, source_path: str) -> str:
+    """Location of the source snapshot that the current test file was generated from."""
+    rel = os.path.relpath(os.path.abspath(source_path), os.path.abspath(repo_path))
+    return os.path.join(repo_path, ".cirkitly", "baselines", rel)
+
+
+def save_baseline(repo_path: str, source_path: str, content: str) -> None:
+    path = baseline_path(repo_path, source_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def load_baseline(repo_path: str, source_path: str):
+    path = baseline_path(repo_path, source_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def function_spans(code: str) -> dict:
+    """Maps each top-level C function definition to its (first, last) 1-based line numbers."""
+    spans = {}
+    for match in C_FUNCTION.finditer(code):
+        depth = 0
+        for end in range(match.end() - 1, len(code)):
+            if code[end] == "{":
+                depth += 1
+            elif code[end] == "}":
+                depth -= 1
+                if depth == 0:
+                    first = code.count("\n", 0, match.start()) + 1
+                    spans[match.group(1)] = (first, code.count("\n", 0, end) + 1)
+                    break
+    return spans
+
+
+def _touched(spans: dict, lines: set) -> set:
+    return {name for name, (first, last) in spans.items() if any(first <= n <= last for n in lines)}
+
+
+def diff_sources(old: str, new: str, filename: str) -> dict:
+    """
+    Returns the unified diff between two versions of a source file along with
+    the functions it touches, split into changed, added and removed.
+    """
+    old_lines, new_lines = old.splitlines(), new.splitlines()
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    old_changed, new_changed = set(), set()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        old_changed.update(range(i1 + 1, i2 + 1) or [max(i1, 1)])
+        new_changed.update(range(j1 + 1, j2 + 1) or [max(j1, 1)])
+
+    old_spans, new_spans = function_spans(old), function_spans(new)
+    touched = _touched(old_spans, old_changed) | _touched(new_spans, new_changed)
+    diff = "\n".join(difflib.unified_diff(
+        old_lines, new_lines, fromfile=f"a/{filename}", tofile=f"b/{filename}", lineterm=""
+    ))
+    return {
+        "diff": diff,
+        "changed": sorted(n for n in touched if n in old_spans and n in new_spans),
+        "added": sorted(n for n in touched if n not in old_spans),
+        "removed": sorted(n for n in touched if n not in new_spans),
+        "new_spans": new_spans,
+    }
+
+
+def function_sources(code: str, names, spans: dict = None) -> str:
+    """Concatenates the definitions of the named functions from `code`."""
+    spans = spans if spans is not None else function_spans(code)
+    lines = code.splitlines()
+    return "\n\n".join("\n".join(lines[spans[n][0] - 1:spans[n][1]]) for n in names if n in spans)
+
+
+def with_callers(code: str, names, spans: dict = None) -> list:
+    """
+    Expands `names` with every function in `code` that calls one of them,
+    directly or through other in-module functions, so a change to a static
+    helper reaches the public functions the tests actually exercise.
+    """
+    spans = spans if spans is not None else function_spans(code)
+    lines = code.splitlines()
+    bodies = {name: "\n".join(lines[first - 1:last]) for name, (first, last) in spans.items()}
+    found = set(names)
+    frontier = set(names)
+    while frontier:
+        calls = re.compile(r"\b(?:" + "|".join(re.escape(n) for n in sorted(frontier)) + r")\s*\(")
+        frontier = {name for name, body in bodies.items() if name not in found and calls.search(body)}
+        found |= frontier
+    return sorted(found)
+
+
+def relevant_tests(test_code: str, function_names) -> dict:
+    """Returns the test functions that call any of the given source functions."""
+    patterns = [re.compile(rf"\b{re.escape(name)}\s*\(") for name in function_names]
+    return {
+        name: body for name, body in extract_test_functions(test_code).items()
+        if any(p.search(body) for p in patterns)
+    }
+
+
+def apply_test_patch(existing: str, patch: str) -> tuple:
+    """
+    Applies a function-level patch to a Unity test file. Returned test functions
+    replace existing ones with the same name or are appended as new tests, and
+    `// REMOVE: test_name` lines delete a test and its RUN_TEST registration.
+    Returns the patched file and a summary of what changed.
+    """
+    patch = extract_c_code(patch)
+
+    summary = {"replaced": [], "added": [], "removed": []}
+    known = extract_test_functions(existing)
+    for name, body in extract_test_functions(patch).items():
+        if name in known:
+            existing = existing.replace(known[name], body, 1)
+            summary["replaced"].append(name)
+
+    for name in REMOVE_MARKER.findall(patch):
+        if name in known and name not in summary["replaced"]:
+            existing = existing.replace(known[name], "", 1)
+            existing = re.sub(rf"^[ \t]*RUN_TEST\(\s*{name}\s*\);[ \t]*\n", "", existing, flags=re.MULTILINE)
+            summary["removed"].append(name)
+
+    existing, summary["added"] = merge_test_functions(existing, patch)
+    return existing, summary
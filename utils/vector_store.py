@@ -0,0 +1,172 @@
+import os
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger("llm_logger")
+
+INT8_SCALE = 127.0
+SEARCH_BLOCK_ROWS = 512
+
+
+def vector_store_dir(repo_path: str) -> str:
+    """Where a project's spec vectors live: VECTOR_STORE_DIR if set, else under the project's .cirkitly/."""
+    return os.getenv("VECTOR_STORE_DIR") or os.path.join(repo_path, ".cirkitly", "vectors")
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+class VectorStore:
+    """
+    Persisted embedding store: L2-normalized vectors quantized to float16 or
+    int8 in a `.npy` file that is memory-mapped on load, plus a JSON sidecar
+    holding the model name and each row's key and content digest.
+    """
+
+    def __init__(self, directory: str, dtype: str = None):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.dtype = np.dtype(dtype or os.getenv("VECTOR_STORE_DTYPE", "float16"))
+        if self.dtype not in (np.float16, np.int8):
+            raise ValueError(f"Unsupported vector store dtype: {self.dtype}")
+        self.meta = {"model": None, "dtype": self.dtype.name, "keys": [], "digests": []}
+        self.vectors = None
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.meta_path) and os.path.exists(self.vectors_path)):
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            vectors = np.load(self.vectors_path, mmap_mode="r")
+        except Exception as e:
+            logger.warning(f"Failed to load vector store, rebuilding: {e}")
+            return
+        keys, digests = meta.get("keys", []), meta.get("digests")
+        if meta.get("dtype") != self.dtype.name or digests is None or not len(keys) == len(digests) == len(vectors):
+            return
+        self.meta, self.vectors = meta, vectors
+
+    def __len__(self):
+        return len(self.meta["keys"])
+
+    def _encode(self, matrix: np.ndarray) -> np.ndarray:
+        matrix = _normalize(matrix)
+        if self.dtype == np.int8:
+            return np.clip(np.rint(matrix * INT8_SCALE), -127, 127).astype(np.int8)
+        return matrix.astype(np.float16)
+
+    def sync(self, items: list, embed, model: str = None) -> int:
+        """
+        Makes the store hold exactly `items` ([(key, digest), ...]), calling
+        `embed(key)` only for keys that are new or whose digest changed. Rows
+        for unchanged keys are reused; vectors from a different model are
+        discarded. Returns the number of newly embedded items.
+        """
+        items = list(dict(items).items())
+        if model != self.meta["model"]:
+            self.meta = {"model": model, "dtype": self.dtype.name, "keys": [], "digests": []}
+            self.vectors = None
+
+        rows = {key: i for i, key in enumerate(self.meta["keys"])}
+        current = dict(zip(self.meta["keys"], self.meta["digests"]))
+        keys = [key for key, _ in items]
+        digests = [digest for _, digest in items]
+        missing = [key for key, digest in items if current.get(key) != digest]
+        if not missing and keys == self.meta["keys"]:
+            return 0
+
+        # Each embedding is quantized into its row as it arrives, straight into the
+        # memory-mapped output file, so no full-precision batch is ever held in memory.
+        pending = {}
+        if self.vectors is not None:
+            dim = self.vectors.shape[1]
+        else:
+            pending[missing[0]] = self._encode(np.asarray(embed(missing[0]), dtype=np.float32)[None])[0]
+            dim = pending[missing[0]].shape[0]
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.vectors_path + ".tmp"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.dtype, shape=(len(keys), dim))
+        missing_keys = set(missing)
+        for i, key in enumerate(keys):
+            if key in pending:
+                matrix[i] = pending.pop(key)
+            elif key in missing_keys:
+                matrix[i] = self._encode(np.asarray(embed(key), dtype=np.float32)[None])[0]
+            else:
+                matrix[i] = self.vectors[rows[key]]
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, self.vectors_path)
+        self.meta.update({"keys": keys, "digests": digests, "dim": int(dim)})
+        self._save_meta()
+        self.vectors = np.load(self.vectors_path, mmap_mode="r")
+        return len(missing)
+
+    def _save_meta(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def search(self, query, k: int = 1) -> list:
+        """Returns the top-k [(cosine similarity, key), ...], best first."""
+        if self.vectors is None or not len(self):
+            return []
+        query = _normalize(query)
+        if self.dtype == np.int8:
+            query = query / INT8_SCALE
+
+        # Score in blocks so only one block is ever widened to float32.
+        scores = np.empty(len(self.vectors), dtype=np.float32)
+        for start in range(0, len(self.vectors), SEARCH_BLOCK_ROWS):
+            block = self.vectors[start:start + SEARCH_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.meta["keys"][i]) for i in top]
+
+
+if __name__ == "__main__":
+    import time
+    import shutil
+    import tempfile
+    import tracemalloc
+
+    dim = 1024
+    rng = np.random.default_rng(0)
+    query = rng.standard_normal(dim).astype(np.float32)
+    print(f"{'chunks':>7} {'dtype':>8} {'disk MB':>8} {'load ms':>8} {'load heap KB':>12} {'query ms':>9}")
+    for n in (1_000, 10_000, 100_000):
+        data = rng.standard_normal((n, dim)).astype(np.float32)
+        for dtype in ("float16", "int8"):
+            directory = tempfile.mkdtemp()
+            try:
+                VectorStore(directory, dtype).sync(
+                    [(str(i), f"chunk-{i}") for i in range(n)], lambda key: data[int(key)].tolist(), model="bench"
+                )
+                tracemalloc.start()
+                start = time.perf_counter()
+                store = VectorStore(directory, dtype)
+                load_ms = (time.perf_counter() - start) * 1000
+                load_heap = tracemalloc.get_traced_memory()[1] / 1024
+                tracemalloc.stop()
+                store.search(query, k=5)
+                start = time.perf_counter()
+                for _ in range(10):
+                    store.search(query, k=5)
+                query_ms = (time.perf_counter() - start) * 100
+                disk_mb = os.path.getsize(store.vectors_path) / 1e6
+                print(f"{n:>7} {dtype:>8} {disk_mb:>8.1f} {load_ms:>8.2f} {load_heap:>12.1f} {query_ms:>9.2f}")
+            finally:
+                shutil.rmtree(directory)